@@ -19,6 +19,8 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import collections
+import concurrent.futures
 import errno
 import os
 import signal
@@ -27,14 +29,14 @@ import subprocess
 import sys
 import syslog
 import time
+import traceback
 
 import apt_pkg
-from apt.cache import Cache
 import debconf
 
 sys.path.insert(0, '/usr/lib/ubiquity')
 
-from ubiquity import install_misc, misc, osextras
+from ubiquity import install_misc, misc, osextras, telemetry
 
 
 class Install(install_misc.InstallBase):
@@ -59,7 +61,8 @@ class Install(install_misc.InstallBase):
         else:
             self.source = '/var/lib/ubiquity/source'
         self.db = debconf.Debconf()
-        self.blacklist = {}
+        self.blacklist = frozenset()
+        self.blacklist_dirs = frozenset()
 
         if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
             self.source = None
@@ -253,7 +256,7 @@ class Install(install_misc.InstallBase):
                     pkgs = {line.strip().split(':')[0] for line in m_file}
                 difference |= pkgs
 
-        cache = Cache()
+        cache = install_misc.shared_cache()
 
         use_restricted = True
         try:
@@ -319,39 +322,44 @@ class Install(install_misc.InstallBase):
             x for x in difference
             if not os.path.exists('/var/lib/dpkg/info/%s.prerm' % x)}
 
+        # We only need to know what would be removed, not to actually mark
+        # anything for removal, so work it out from the dependency graph.
+        graph = install_misc.dependency_graph(cache)
+        removal = graph.removal()
+        candidates = graph.lookup(difference)
         confirmed_remove = set()
-        with cache.actiongroup():
-            for pkg in sorted(difference):
-                if pkg in confirmed_remove:
-                    continue
-                would_remove = install_misc.get_remove_list(
-                    cache, [pkg], recursive=True)
-                if would_remove <= difference:
-                    confirmed_remove |= would_remove
-                    # Leave these marked for removal in the apt cache to
-                    # speed up further calculations.
-                else:
-                    for removedpkg in would_remove:
-                        cachedpkg = install_misc.get_cache_pkg(
-                            cache, removedpkg)
-                        cachedpkg.mark_keep()
-        difference = confirmed_remove
+        for pkg in sorted(candidates, key=graph.names.__getitem__):
+            if removal.removed[pkg]:
+                continue
+            would_remove = removal.closure([pkg])
+            if would_remove <= candidates:
+                # Count these as removed to speed up further calculations.
+                removal.remove(would_remove)
+                confirmed_remove |= would_remove
+        difference = {graph.names[pkg] for pkg in confirmed_remove}
 
         if len(difference) == 0:
             del cache
-            self.blacklist = {}
+            self.blacklist = frozenset()
+            self.blacklist_dirs = frozenset()
             return
 
-        cmd = ['dpkg', '-L']
-        cmd.extend(difference)
-        subp = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True)
-        res = subp.communicate()[0].splitlines()
-        u = {}
-        for x in res:
-            u[x] = 1
-        self.blacklist = u
+        self.blacklist, self.blacklist_dirs = install_misc.files_to_skip(
+            difference)
+        syslog.syslog('Not copying %d files, including %d whole directories'
+                      % (len(self.blacklist), len(self.blacklist_dirs)))
+
+    def copy_workers(self):
+        """How many threads should copy_all use to copy files?"""
+        try:
+            workers = int(self.db.get('ubiquity/install/copy_workers'))
+        except (debconf.DebconfError, ValueError):
+            workers = 0
+        if workers <= 0:
+            # Copying is mostly I/O-bound, but there's little point in
+            # having many more threads than we can run at once.
+            workers = min(os.cpu_count() or 1, 8)
+        return workers
 
     def copy_all(self):
         """Core copy process. This is the most important step of this
@@ -361,26 +369,37 @@ class Install(install_misc.InstallBase):
         self.db.progress('START', 0, 100, 'ubiquity/install/title')
         self.db.progress('INFO', 'ubiquity/install/copying')
 
-        fs_size = os.path.join(self.casper_path, 'filesystem.size')
-        if os.path.exists(fs_size):
-            with open(fs_size) as total_size_fp:
-                total_size = int(total_size_fp.readline())
+        # If the live medium has a copy manifest, then it tells us
+        # everything we need to know about the live filesystem in one
+        # sequential read, and we don't have to walk the source at all.
+        manifest = install_misc.read_copy_manifest(
+            os.path.join(self.casper_path, 'filesystem.copymanifest'),
+            prune=self.blacklist_dirs,
+            squashfs=os.path.join(self.casper_path, 'filesystem.squashfs'))
+        if manifest is not None:
+            total_size, entries = manifest
+            syslog.syslog('Copying files listed in the copy manifest')
         else:
-            # Fallback in case an Ubuntu derivative forgets to put
-            # /casper/filesystem.size on the CD, or to account for things
-            # like CD->USB transformation tools that don't copy this file.
-            # This is slower than just reading the size from a file, but
-            # better than crashing.
-            #
-            # Obviously doing os.walk() twice is inefficient, but I'd rather
-            # not suck the list into ubiquity's memory, and I'm guessing
-            # that the kernel's dentry cache will avoid most of the slowness
-            # anyway.
-            total_size = 0
-            for dirpath, dirnames, filenames in os.walk(self.source):
-                for name in dirnames + filenames:
-                    fqpath = os.path.join(dirpath, name)
-                    total_size += os.lstat(fqpath).st_size
+            entries = install_misc.walk_source(
+                self.source, prune=self.blacklist_dirs)
+            fs_size = os.path.join(self.casper_path, 'filesystem.size')
+            if os.path.exists(fs_size):
+                with open(fs_size) as total_size_fp:
+                    total_size = int(total_size_fp.readline())
+            else:
+                # Fallback in case an Ubuntu derivative forgets to put
+                # /casper/filesystem.size on the CD, or to account for
+                # things like CD->USB transformation tools that don't copy
+                # this file.  This is slower than just reading the size
+                # from a file, but better than crashing.
+                #
+                # Obviously walking the tree twice is inefficient, but I'd
+                # rather not suck the list into ubiquity's memory, and I'm
+                # guessing that the kernel's dentry cache will avoid most of
+                # the slowness anyway.
+                total_size = 0
+                for entry in install_misc.walk_source(self.source):
+                    total_size += entry.st.st_size
 
         # Progress bar handling:
         # We sample progress every half-second (assuming time.time() gives
@@ -402,28 +421,167 @@ class Install(install_misc.InstallBase):
             md5_check = False
         else:
             md5_check = True
+        if md5_check:
+            strict_verify = (
+                self.db.get('ubiquity/install/strict_verify') == 'true')
+            hashes = install_misc.load_hash_manifest(
+                os.path.join(self.casper_path, 'filesystem.b2sums'))
+            if hashes:
+                syslog.syslog('Verifying copied files against %d checksums '
+                              'from the live medium' % len(hashes))
+        else:
+            strict_verify = False
+            hashes = {}
+
+        # Rather than letting copied data pile up in the page cache and
+        # then flushing it all at the end, start writing each file out as
+        # soon as it has been copied, and keep the amount of outstanding
+        # dirty data bounded.  Delayed allocation still gets to see each
+        # file in full before we ask for it to be written, so small files
+        # are still laid out contiguously.
+        writeback = install_misc.WritebackManager()
+
+        # Regular files are copied by a pool of worker threads, while
+        # everything else (including creating directories, which must exist
+        # before anything can be copied into them) is done here in walk
+        # order.  Each worker copies one file's contents and then its
+        # metadata while it still has the file open; metadata for other
+        # things we create here is applied by the workers too.  We only reap
+        # their results here in order to keep the progress bar moving and
+        # to deal with any debconf interaction.
+        workers = self.copy_workers()
+        syslog.syslog('Copying files using %d worker(s)' % workers)
+        if workers > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers)
+        else:
+            executor = None
+        pending = collections.deque()
 
-        # Increase kernel flush times during bulk data copying to make it
-        # more likely that small files are packed contiguously, which should
-        # speed up initial boot times.
-        dirty_writeback_centisecs = None
-        dirty_expire_centisecs = None
-        if os.path.exists('/proc/sys/vm/dirty_writeback_centisecs'):
-            with open('/proc/sys/vm/dirty_writeback_centisecs') as dwc:
-                dirty_writeback_centisecs = int(dwc.readline())
-            with open('/proc/sys/vm/dirty_writeback_centisecs', 'w') as dwc:
-                print('3000\n', file=dwc)
-        if os.path.exists('/proc/sys/vm/dirty_expire_centisecs'):
-            with open('/proc/sys/vm/dirty_expire_centisecs') as dec:
-                dirty_expire_centisecs = int(dec.readline())
-            with open('/proc/sys/vm/dirty_expire_centisecs', 'w') as dec:
-                print('6000\n', file=dec)
+        # If the live filesystem has no extended attributes at all, then
+        # there's no point asking about them for every file.
+        if install_misc.source_has_xattrs(self.source):
+            no_xattrs = None
+        else:
+            syslog.syslog('%s has no extended attributes' % self.source)
+            no_xattrs = []
+
+        # Keep track of where the time goes, so that we can tell why
+        # copying is slow on any given system.
+        stats = telemetry.CopyStats()
+
+        # Keep a journal of the files we've finished copying, so that if
+        # we're interrupted and then run again we can carry on from where
+        # we left off rather than copying everything again.
+        journal = install_misc.CopyJournal(
+            self.target_file('.ubiquity-copy-journal'))
+        if journal.done:
+            syslog.syslog('Resuming copy: %d files already copied' %
+                          len(journal.done))
+
+        def copy_regular(sourcepath, targetpath, st, xattrs, expected):
+            timer = telemetry.CopyTimer()
+            ret = install_misc.copy_file_data(
+                sourcepath, targetpath, md5_check, expected=expected,
+                strict=strict_verify, st=st, xattrs=xattrs, timer=timer,
+                writeback=writeback)
+            stats.add(timer, st.st_size)
+            return ret
+
+        def copy_other(sourcepath, targetpath, st, xattrs, expected):
+            timer = telemetry.CopyTimer()
+            install_misc.copy_metadata(
+                sourcepath, targetpath, st, xattrs=xattrs)
+            timer.lap('metadata')
+            stats.add(timer, regular=False)
+            return True
+
+        def copied(size):
+            nonlocal copied_size, copy_progress, time_last_update
+            nonlocal long_enough
+
+            copied_size += size
+            if int((copied_size * 90) / total_size) != copy_progress:
+                copy_progress = int((copied_size * 90) / total_size)
+                self.db.progress('SET', 10 + copy_progress)
+
+            time_now = time.time()
+            if (time_now - times[-1][0]) >= 0.5:
+                times.append((time_now, copied_size))
+                if not long_enough and time_now - times[0][0] >= 10:
+                    long_enough = True
+                if long_enough and time_now - time_last_update >= 2:
+                    time_last_update = time_now
+                    while (time_now - times[0][0] > 60 and
+                           time_now - times[1][0] >= 60):
+                        times.pop(0)
+                    speed = ((times[-1][1] - times[0][1]) /
+                             (times[-1][0] - times[0][0]))
+                    if speed != 0:
+                        time_remaining = (
+                            int((total_size - copied_size) / speed))
+                        if time_remaining < 60:
+                            self.db.progress(
+                                'INFO', 'ubiquity/install/copying_minute')
+
+        def retry(sourcepath, targetpath, st, xattrs, expected):
+            # The checksum failed; ask the user what to do before trying
+            # again.  This has to happen here rather than in the worker,
+            # since we can't talk to debconf from more than one thread.
+            # Return True if a retry succeeded.
+            while install_misc.ask_copy_error(self.db, targetpath) != 'skip':
+                if copy_regular(sourcepath, targetpath, st, xattrs, expected):
+                    return True
+            return False
+
+        def finished(job, ok):
+            sourcepath, targetpath, st, xattrs, expected = job
+            if not ok:
+                ok = retry(*job)
+            if ok and stat.S_ISREG(st.st_mode):
+                # Everything else is cheap enough to create again.
+                journal.record(
+                    os.path.relpath(targetpath, self.target), st, expected)
+            copied(st.st_size)
+
+        def reap(job):
+            finished(job[1:], job[0].result())
+
+        def run_job(func, job):
+            if executor is None:
+                finished(job, func(*job))
+            else:
+                pending.append((executor.submit(func, *job),) + job)
+                # Bound the amount of outstanding work so that we don't
+                # hold the whole tree in memory.
+                while pending and (pending[0][0].done() or
+                                   len(pending) >= workers * 16):
+                    reap(pending.popleft())
+
+        # Reading files in the order in which they were found can mean
+        # seeking all over the live medium, which is slow on USB sticks and
+        # optical media.  If asked to, we gather regular files into batches
+        # and read each batch in the order in which it is laid out on the
+        # medium instead.  Directories are still created as we find them,
+        # so they exist by the time we get round to copying their contents.
+        order = self.db.get('ubiquity/install/copy_read_order')
+        order_key = install_misc.read_order_key(order)
+        batch = []
+        batch_size = 16384
+        if order_key is not None:
+            syslog.syslog('Reading files in %s order' % order)
+
+        def copy_batch():
+            batch.sort(key=lambda job: order_key(job[0], job[2]))
+            for job in batch:
+                run_job(copy_regular, job)
+            del batch[:]
 
         old_umask = os.umask(0)
-        for dirpath, dirnames, filenames in os.walk(self.source):
-            sp = dirpath[len(self.source) + 1:]
-            for name in dirnames + filenames:
-                relpath = os.path.join(sp, name)
+        copy_done = False
+        try:
+            for entry in entries:
+                relpath = entry.relpath
                 # /etc/fstab was legitimately created by partman, and
                 # shouldn't be copied again.  Similarly, /etc/crypttab may
                 # have been legitimately created by the user-setup plugin.
@@ -431,24 +589,53 @@ class Install(install_misc.InstallBase):
                     continue
                 sourcepath = os.path.join(self.source, relpath)
                 targetpath = os.path.join(self.target, relpath)
-                st = os.lstat(sourcepath)
+                st = entry.st
 
-                # Is the path blacklisted?
+                # Is the path blacklisted?  (Whole blacklisted directories
+                # have already been skipped.)
                 if (not stat.S_ISDIR(st.st_mode) and
                         '/' in relpath and
-                        '/%s' % relpath in self.blacklist):
+                        relpath in self.blacklist):
                     if debug:
                         syslog.syslog('Not copying %s' % relpath)
                     continue
 
+                if stat.S_ISREG(st.st_mode):
+                    if entry.digest is not None:
+                        expected = entry.digest
+                    else:
+                        expected = hashes.get(relpath)
+                    # Did an earlier attempt already copy this file?
+                    if journal.completed(relpath, targetpath, st, expected):
+                        copied(st.st_size)
+                        continue
+
                 # Remove the target if necessary and if we can.
                 install_misc.remove_target(
                     self.source, self.target, relpath, st)
 
+                if entry.xattrs is not None:
+                    xattrs = entry.xattrs
+                else:
+                    xattrs = no_xattrs
+
+                if stat.S_ISREG(st.st_mode):
+                    job = (sourcepath, targetpath, st, xattrs, expected)
+                    if order_key is None:
+                        run_job(copy_regular, job)
+                    else:
+                        batch.append(job)
+                        if len(batch) >= batch_size:
+                            copy_batch()
+                    continue
+
                 # Now actually copy source to target.
                 mode = stat.S_IMODE(st.st_mode)
                 if stat.S_ISLNK(st.st_mode):
-                    linkto = os.readlink(sourcepath)
+                    if entry.linkto is not None:
+                        linkto = entry.linkto
+                    else:
+                        linkto = os.readlink(sourcepath)
                     os.symlink(linkto, targetpath)
                 elif stat.S_ISDIR(st.st_mode):
                     if not os.path.isdir(targetpath):
@@ -462,6 +649,8 @@ class Install(install_misc.InstallBase):
                             # brief moments before it didn't.
                             if e.errno != errno.EEXIST:
                                 raise
+                    directory_times.append(
+                        (targetpath, st.st_atime, st.st_mtime))
                 elif stat.S_ISCHR(st.st_mode):
                     os.mknod(targetpath, stat.S_IFCHR | mode, st.st_rdev)
                 elif stat.S_ISBLK(st.st_mode):
@@ -470,64 +659,32 @@ class Install(install_misc.InstallBase):
                     os.mknod(targetpath, stat.S_IFIFO | mode)
                 elif stat.S_ISSOCK(st.st_mode):
                     os.mknod(targetpath, stat.S_IFSOCK | mode)
-                elif stat.S_ISREG(st.st_mode):
-                    install_misc.copy_file(
-                        self.db, sourcepath, targetpath, md5_check)
 
                 # Copy metadata.
-                copied_size += st.st_size
-                os.lchown(targetpath, st.st_uid, st.st_gid)
-                if not stat.S_ISLNK(st.st_mode):
-                    os.chmod(targetpath, mode)
-                if stat.S_ISDIR(st.st_mode):
-                    directory_times.append(
-                        (targetpath, st.st_atime, st.st_mtime))
-                # os.utime() sets timestamp of target, not link
-                elif not stat.S_ISLNK(st.st_mode):
-                    try:
-                        os.utime(targetpath, (st.st_atime, st.st_mtime))
-                    except Exception:
-                        # We can live with timestamps being wrong.
-                        pass
-                if (hasattr(os, "listxattr") and
-                        hasattr(os, "supports_follow_symlinks") and
-                        os.supports_follow_symlinks):
-                    try:
-                        attrnames = os.listxattr(
-                            sourcepath, follow_symlinks=False)
-                        for attrname in attrnames:
-                            attrvalue = os.getxattr(
-                                sourcepath, attrname, follow_symlinks=False)
-                            os.setxattr(
-                                targetpath, attrname, attrvalue,
-                                follow_symlinks=False)
-                    except OSError as e:
-                        if e.errno not in (
-                                errno.EPERM, errno.ENOTSUP, errno.ENODATA):
-                            raise
-
-                if int((copied_size * 90) / total_size) != copy_progress:
-                    copy_progress = int((copied_size * 90) / total_size)
-                    self.db.progress('SET', 10 + copy_progress)
-
-                time_now = time.time()
-                if (time_now - times[-1][0]) >= 0.5:
-                    times.append((time_now, copied_size))
-                    if not long_enough and time_now - times[0][0] >= 10:
-                        long_enough = True
-                    if long_enough and time_now - time_last_update >= 2:
-                        time_last_update = time_now
-                        while (time_now - times[0][0] > 60 and
-                               time_now - times[1][0] >= 60):
-                            times.pop(0)
-                        speed = ((times[-1][1] - times[0][1]) /
-                                 (times[-1][0] - times[0][0]))
-                        if speed != 0:
-                            time_remaining = (
-                                int((total_size - copied_size) / speed))
-                            if time_remaining < 60:
-                                self.db.progress(
-                                    'INFO', 'ubiquity/install/copying_minute')
+                run_job(copy_other, (sourcepath, targetpath, st, xattrs, None))
+
+            copy_batch()
+            while pending:
+                reap(pending.popleft())
+            stats.finish()
+            copy_done = True
+        finally:
+            try:
+                if executor is not None:
+                    executor.shutdown(wait=True, cancel_futures=True)
+                try:
+                    writeback.drain()
+                except OSError:
+                    # Don't let this hide whatever went wrong with the copy.
+                    if copy_done:
+                        raise
+                    syslog.syslog(syslog.LOG_WARNING,
+                                  'Failed to write back copied files:')
+                    for line in traceback.format_exc().split('\n'):
+                        syslog.syslog(syslog.LOG_WARNING, line)
+            finally:
+                journal.close()
+        journal.remove()
 
         # Apply timestamps to all directories now that the items within them
         # have been copied.
@@ -540,14 +697,6 @@ class Install(install_misc.InstallBase):
                 # about this failing, but I really don't care. Ignore it.
                 pass
 
-        # Revert to previous kernel flush times.
-        if dirty_writeback_centisecs is not None:
-            with open('/proc/sys/vm/dirty_writeback_centisecs', 'w') as dwc:
-                print(dirty_writeback_centisecs, file=dwc)
-        if dirty_expire_centisecs is not None:
-            with open('/proc/sys/vm/dirty_expire_centisecs', 'w') as dec:
-                print(dirty_expire_centisecs, file=dec)
-
         # Try some possible locations for the kernel we used to boot. This
         # lets us save a couple of megabytes of CD space.
         bootdir = self.target_file('boot')
@@ -579,7 +728,8 @@ class Install(install_misc.InstallBase):
 
             for source, target in copies:
                 osextras.unlink_force(target)
-                install_misc.copy_file(self.db, source, target, md5_check)
+                install_misc.copy_file(self.db, source, target, md5_check,
+                                       strict=strict_verify)
                 os.lchown(target, 0, 0)
                 os.chmod(target, 0o644)
                 st = os.lstat(source)
@@ -595,6 +745,8 @@ class Install(install_misc.InstallBase):
 
         os.umask(old_umask)
 
+        stats.save('/var/log/installer/copy-stats')
+
         self.db.progress('SET', 100)
         self.db.progress('STOP')
 
@@ -19,6 +19,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import concurrent.futures
 import gzip
 import io
 import itertools
@@ -93,6 +94,7 @@ class Install(install_misc.InstallBase):
 
         self.kernel_version = platform.release()
         self.re_kernel_version = re.compile(r'^linux-image-\d.*')
+        self.restricted_extras_installed = False
 
         # Get langpacks from install
         self.langpacks = []
@@ -163,6 +165,8 @@ class Install(install_misc.InstallBase):
     @cleanup_after
     def run(self):
         """Main entry point."""
+        self.triggers = install_misc.TriggerDeferral(self.target)
+
         # We pick up where install.py left off.
         if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
             self.prev_count = 0
@@ -192,35 +196,51 @@ class Install(install_misc.InstallBase):
         self.next_region()
         self.run_target_config_hooks()
 
-        self.next_region(size=5)
-        # Ignore failures from language pack installation.
-        try:
-            self.install_language_packs()
-        except install_misc.InstallStepError:
-            pass
-        except IOError:
-            pass
-        except SystemError:
-            pass
+        # While installing and later removing the extras, hold back dpkg
+        # triggers and initramfs generation so that each of them only runs
+        # once rather than after every package operation.  The boot loader
+        # needs every kernel's initramfs in place, so stop deferring before
+        # configuring it.
+        if not self.triggers.start():
+            syslog.syslog(syslog.LOG_WARNING,
+                          'Not deferring triggers while installing extras')
+
+        # Keep the target set up for package operations across the
+        # following steps rather than setting it up for each of them.  The
+        # bootloader and Active Directory steps do their own bind mounts
+        # and run d-i's in-target, so we let go of it around those.
+        with install_misc.chroot(self.target):
+            self.next_region(size=5)
+            # Ignore failures from language pack installation.
+            try:
+                self.install_language_packs()
+            except install_misc.InstallStepError:
+                pass
+            except IOError:
+                pass
+            except SystemError:
+                pass
 
-        self.next_region()
-        self.remove_unusable_kernels()
+            self.next_region()
+            self.remove_unusable_kernels()
 
-        self.next_region(size=4)
-        self.db.progress('INFO', 'ubiquity/install/hardware')
-        self.configure_hardware()
+            self.next_region(size=4)
+            self.db.progress('INFO', 'ubiquity/install/hardware')
+            self.configure_hardware()
 
-        # Tell apt-install to install packages directly from now on.
-        with open('/var/lib/ubiquity/apt-install-direct', 'w'):
-            pass
+            # Tell apt-install to install packages directly from now on.
+            with open('/var/lib/ubiquity/apt-install-direct', 'w'):
+                pass
 
-        self.next_region()
-        self.db.progress('INFO', 'ubiquity/install/installing')
+            self.next_region()
+            self.db.progress('INFO', 'ubiquity/install/installing')
 
-        if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
-            self.install_oem_extras()
-        else:
-            self.install_extras()
+            if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
+                self.install_oem_extras()
+            else:
+                self.install_extras()
+
+            self.triggers.finish()
 
         # Configure zsys
         self.configure_zsys()
@@ -235,20 +255,31 @@ class Install(install_misc.InstallBase):
         self.configure_recovery_key()
         self.configure_bootloader()
 
-        self.next_region(size=4)
-        self.db.progress('INFO', 'ubiquity/install/removing')
-        if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
-            try:
-                if misc.create_bool(self.db.get('oem-config/remove_extras')):
-                    self.remove_oem_extras()
-            except debconf.DebconfError:
-                pass
-        else:
-            self.remove_extras()
+        if not self.triggers.start():
+            syslog.syslog(syslog.LOG_WARNING,
+                          'Not deferring triggers while removing extras')
+        with install_misc.chroot(self.target):
+            self.next_region(size=4)
+            self.db.progress('INFO', 'ubiquity/install/removing')
+            if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
+                try:
+                    if misc.create_bool(
+                            self.db.get('oem-config/remove_extras')):
+                        self.remove_oem_extras()
+                except debconf.DebconfError:
+                    pass
+            else:
+                self.remove_extras()
 
-        self.next_region()
-        if 'UBIQUITY_OEM_USER_CONFIG' not in os.environ:
-            self.install_restricted_extras()
+            self.next_region()
+            if 'UBIQUITY_OEM_USER_CONFIG' not in os.environ:
+                self.install_restricted_extras()
+
+            # The boot loader has already been configured, so pick up any
+            # kernel that only got its initramfs just now.
+            if (self.triggers.finish() and
+                    os.path.exists(self.target_file('usr/sbin/update-grub'))):
+                install_misc.chrex(self.target, 'update-grub')
 
         try:
             self.copy_network_config()
@@ -317,7 +348,12 @@ class Install(install_misc.InstallBase):
         Recreate them now to restore the appearance of a system installed
         from .debs.
         """
-        cache = Cache()
+        cache = install_misc.shared_cache()
+
+        # Byte-compiling is CPU-bound, so we split the work into jobs and
+        # run as many at once as we have CPUs.
+        workers = os.cpu_count() or 1
+        jobs = []
 
         # Python standard library.
         re_minimal = re.compile(r'^python\d+\.\d+-minimal$')
@@ -327,17 +363,16 @@ class Install(install_misc.InstallBase):
         for python in python_installed:
             re_file = re.compile(r'^/usr/lib/%s/.*\.py$' % python)
             files = [
-                f for f in cache['%s-minimal' % python].installed_files
-                if (re_file.match(f) and
-                    not os.path.exists(self.target_file('%sc' % f[1:])))]
-            install_misc.chrex(self.target, python,
-                               '/usr/lib/%s/py_compile.py' % python, *files)
-            files = [
-                f for f in cache[python].installed_files
+                f for f in (cache['%s-minimal' % python].installed_files +
+                            cache[python].installed_files)
                 if (re_file.match(f) and
-                    not os.path.exists(self.target_file('%sc' % f[1:])))]
-            install_misc.chrex(self.target, python,
-                               '/usr/lib/%s/py_compile.py' % python, *files)
+                    not install_misc.bytecode_is_current(
+                        self.target_file(f[1:]), python))]
+            for i in range(workers):
+                if files[i::workers]:
+                    jobs.append(
+                        [python, '/usr/lib/%s/py_compile.py' % python] +
+                        files[i::workers])
 
         # Modules provided by the core Debian Python packages.
         default = subprocess.Popen(
@@ -345,12 +380,19 @@ class Install(install_misc.InstallBase):
             stdout=subprocess.PIPE,
             universal_newlines=True).communicate()[0].rstrip('\n')
         if default:
-            install_misc.chrex(self.target, default, '-m', 'compileall',
-                               '/usr/share/python/')
+            jobs.append([default, '-m', 'compileall', '/usr/share/python/'])
         if osextras.find_on_path_root(self.target, 'py3compile'):
-            install_misc.chrex(self.target, 'py3compile', '-p', 'python3',
-                               '/usr/share/python3/')
+            jobs.append(['py3compile', '-p', 'python3', '/usr/share/python3/'])
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as executor:
+            for _ in executor.map(
+                    lambda job: install_misc.chrex(self.target, *job), jobs):
+                pass
 
+        # These hooks typically byte-compile everything for some other
+        # Python tool, and may share state with each other, so they run one
+        # at a time.
         def run_hooks(path, *args):
             for hook in osextras.glob_root(self.target, path):
                 if not os.access(self.target_file(hook[1:]), os.X_OK):
@@ -631,7 +673,7 @@ class Install(install_misc.InstallBase):
         if self.db.get('pkgsel/ignore-incomplete-language-support') == 'true':
             return
 
-        cache = Cache()
+        cache = install_misc.shared_cache()
         incomplete = False
         for pkg in self.langpacks:
             if pkg.startswith('gimp-help-'):
@@ -709,7 +751,7 @@ class Install(install_misc.InstallBase):
                         new_kernel_version = kernel[12:]
                     elif kernel.startswith('linux-'):
                         # Traverse dependencies to find the real kernel image.
-                        cache = Cache()
+                        cache = install_misc.shared_cache()
                         kernel = self.traverse_for_kernel(cache, kernel)
                         if kernel:
                             new_kernel_pkg = kernel
@@ -735,7 +777,7 @@ class Install(install_misc.InstallBase):
             self.do_install(install_kernels)
             install_misc.record_installed(install_kernels)
             if new_kernel_pkg:
-                cache = Cache()
+                cache = install_misc.shared_cache()
                 cached_pkg = install_misc.get_cache_pkg(cache, new_kernel_pkg)
                 if cached_pkg is not None and cached_pkg.is_installed:
                     self.kernel_version = new_kernel_version
@@ -784,7 +826,7 @@ class Install(install_misc.InstallBase):
         misc.execute(script)
 
         osextras.unlink_force(self.target_file('etc/papersize'))
-        subprocess.call(['log-output', '-t', 'ubiquity', 'chroot', self.target,
+        misc.run_logged(['chroot', self.target,
                          'ucf', '--purge', '/etc/papersize'],
                         preexec_fn=install_misc.debconf_disconnect,
                         close_fds=True)
@@ -804,14 +846,21 @@ class Install(install_misc.InstallBase):
         os.symlink('../proc/self/mounts', self.target_file('etc/mtab'))
 
         install_misc.chroot_setup(self.target, x11=True)
-        install_misc.chrex(
-            self.target, 'dpkg-divert', '--package', 'ubiquity', '--rename',
-            '--quiet', '--add', '/usr/sbin/update-initramfs')
-        try:
-            os.symlink(
-                '/bin/true', self.target_file('usr/sbin/update-initramfs'))
-        except OSError:
-            pass
+        # If triggers aren't being deferred, then keep the kernel's
+        # postinst from building an initramfs that we're about to build
+        # anyway.
+        divert_initramfs = (
+            not self.triggers.active and
+            install_misc.chrex(
+                self.target, 'dpkg-divert', '--package', 'ubiquity',
+                '--rename', '--quiet', '--add', '/usr/sbin/update-initramfs'))
+        if divert_initramfs:
+            try:
+                os.symlink(
+                    '/bin/true',
+                    self.target_file('usr/sbin/update-initramfs'))
+            except OSError:
+                pass
 
         packages = ['linux-image-' + self.kernel_version,
                     'libpaper1',
@@ -822,15 +871,16 @@ class Install(install_misc.InstallBase):
             for package in packages:
                 install_misc.reconfigure(self.target, package)
         finally:
-            osextras.unlink_force(
-                self.target_file('usr/sbin/update-initramfs'))
-            install_misc.chrex(
-                self.target, 'dpkg-divert', '--package', 'ubiquity',
-                '--rename', '--quiet', '--remove',
-                '/usr/sbin/update-initramfs')
-            install_misc.chrex(
-                self.target, 'update-initramfs', '-c',
-                '-k', self.kernel_version)
+            if divert_initramfs:
+                osextras.unlink_force(
+                    self.target_file('usr/sbin/update-initramfs'))
+                install_misc.chrex(
+                    self.target, 'dpkg-divert', '--package', 'ubiquity',
+                    '--rename', '--quiet', '--remove',
+                    '/usr/sbin/update-initramfs')
+            # update-initramfs is otherwise deferred to the end of the
+            # install, but the kernel symlinks below need an initrd now.
+            self.triggers.initramfs('-c', '-k', self.kernel_version)
             install_misc.chroot_cleanup(self.target, x11=True)
 
         # Fix up kernel symlinks now that the initrd exists. Depending on
@@ -1102,7 +1152,16 @@ class Install(install_misc.InstallBase):
 
             shutil.copy(source_file, target_file)
 
-    def do_remove(self, to_remove, recursive=False):
+    def do_remove(self, to_remove, recursive=(), to_install=()):
+        """Remove packages in a single apt transaction.
+
+        Packages in to_remove are removed along with anything that only
+        they break; packages in recursive are removed along with anything
+        that depends on them.  If we can, we also install to_install in the
+        same transaction, which saves a separate run of dpkg and all its
+        triggers.  Return True if we did that, or False if to_install still
+        needs to be installed separately.
+        """
         self.nested_progress_start()
 
         self.db.progress('START', 0, 5, 'ubiquity/install/title')
@@ -1112,7 +1171,7 @@ class Install(install_misc.InstallBase):
             self.db, 'ubiquity/install/title',
             'ubiquity/install/apt_indices_starting',
             'ubiquity/install/apt_indices')
-        cache = Cache()
+        cache = install_misc.shared_cache()
 
         if cache._depcache.broken_count > 0:
             syslog.syslog(
@@ -1120,16 +1179,40 @@ class Install(install_misc.InstallBase):
                 '%s' % ', '.join(install_misc.broken_packages(cache)))
             self.db.progress('STOP')
             self.nested_progress_end()
-            return
-
-        with cache.actiongroup():
-            install_misc.get_remove_list(cache, to_remove, recursive)
+            return False
 
-        with cache.actiongroup():
-            for cachedpkg in cache:
-                if cachedpkg.is_auto_removable and not cachedpkg.marked_delete:
-                    syslog.syslog("Autopurge %s" % cachedpkg.name)
-                    cachedpkg.mark_delete(auto_fix=False, purge=True)
+        def mark_remove():
+            with cache.actiongroup():
+                install_misc.get_remove_list(cache, to_remove)
+                install_misc.get_remove_list(cache, recursive, recursive=True)
+            removed = [pkg for pkg in cache.get_changes() if pkg.marked_delete]
+
+            with cache.actiongroup():
+                for cachedpkg in cache:
+                    if (cachedpkg.is_auto_removable and
+                            not cachedpkg.marked_delete):
+                        syslog.syslog("Autopurge %s" % cachedpkg.name)
+                        cachedpkg.mark_delete(auto_fix=False, purge=True)
+            return removed
+
+        removed = mark_remove()
+        installed = False
+        if to_install:
+            # mark_install gives up on removals if that's what it takes to
+            # fix broken packages, in which case we have to do this the
+            # slow way.
+            try:
+                with cache.actiongroup():
+                    install_misc.mark_install(cache, to_install)
+                installed = all(pkg.marked_delete for pkg in removed)
+            except install_misc.InstallStepError:
+                pass
+            if not installed:
+                syslog.syslog('Cannot install %s while removing packages; '
+                              'installing them separately' %
+                              ', '.join(sorted(to_install)))
+                cache.clear()
+                mark_remove()
 
         self.db.progress('SET', 1)
         self.progress_region(1, 5)
@@ -1143,21 +1226,39 @@ class Install(install_misc.InstallBase):
         commit_error = None
         try:
             try:
-                if not cache.commit(fetchprogress, installprogress):
+                if installed:
+                    try:
+                        committed = self.commit_with_verify(
+                            cache, fetchprogress, installprogress)
+                    except IOError:
+                        # A download failed, so nothing has been unpacked
+                        # yet.  Carry on with just the removals, and leave
+                        # to_install for install_restricted_extras.
+                        for line in traceback.format_exc().split('\n'):
+                            syslog.syslog(syslog.LOG_ERR, line)
+                        installed = False
+                        cache.clear()
+                        mark_remove()
+                        committed = cache.commit(
+                            fetchprogress, installprogress)
+                else:
+                    committed = cache.commit(fetchprogress, installprogress)
+                if not committed:
                     fetchprogress.stop()
                     installprogress.finish_update()
                     self.db.progress('STOP')
                     self.nested_progress_end()
-                    return
+                    return False
             except SystemError as e:
                 for line in traceback.format_exc().split('\n'):
                     syslog.syslog(syslog.LOG_ERR, line)
                 commit_error = str(e)
+                installed = False
         finally:
             install_misc.chroot_cleanup(self.target)
         self.db.progress('SET', 5)
 
-        cache.open(None)
+        cache = install_misc.shared_cache()
         if commit_error or cache._depcache.broken_count > 0:
             if commit_error is None:
                 commit_error = ''
@@ -1174,6 +1275,7 @@ class Install(install_misc.InstallBase):
         self.db.progress('STOP')
 
         self.nested_progress_end()
+        return installed
 
     def install_oem_extras(self):
         """Try to install additional packages requested by the distributor."""
@@ -1245,7 +1347,7 @@ class Install(install_misc.InstallBase):
                 subprocess.check_call(cmd)
             except subprocess.CalledProcessError as e:
                 if e.returncode != 30:
-                    cache = Cache()
+                    cache = install_misc.shared_cache()
                     brokenpkgs = install_misc.broken_packages(cache)
                     self.warn_broken_packages(brokenpkgs, str(e))
         finally:
@@ -1262,14 +1364,21 @@ class Install(install_misc.InstallBase):
         if inst_langpacks:
             self.verify_language_packs()
 
-    def install_restricted_extras(self):
+    def restricted_extras(self):
         packages = []
         if self.db.get('ubiquity/use_nonfree') == 'true':
-            self.db.progress('INFO', 'ubiquity/install/nonfree')
             packages.extend(self.db.get('ubiquity/nonfree_package').split())
         # also install recorded non-free packages
         packages.extend(install_misc.query_recorded_installed())
-        self.do_install(packages)
+        return packages
+
+    def install_restricted_extras(self):
+        if self.restricted_extras_installed:
+            # remove_extras already took care of these.
+            return
+        if self.db.get('ubiquity/use_nonfree') == 'true':
+            self.db.progress('INFO', 'ubiquity/install/nonfree')
+        self.do_install(self.restricted_extras())
 
     def install_extras(self):
         """Try to install packages requested by installer components."""
@@ -1291,7 +1400,7 @@ class Install(install_misc.InstallBase):
         # will be installed by install_restricted_extras() later
         # because this function runs before i386 foreign arch is
         # enabled
-        cache = Cache()
+        cache = install_misc.shared_cache()
         filtered_extra_packages = install_misc.query_recorded_installed()
         for package in sorted(filtered_extra_packages):
             pkg = cache.get(package)
@@ -1321,7 +1430,7 @@ class Install(install_misc.InstallBase):
 
                         try:
                             cache.update(sources_list=target_sources_list)
-                            cache.open()
+                            cache = install_misc.shared_cache()
                         except FetchFailedException:
                             syslog.syslog("Failed to apt update {}".format(target_sources_list))
                             oem_pkgs.discard(oem_pkg)
@@ -1419,7 +1528,7 @@ class Install(install_misc.InstallBase):
         keep.add('ubiquity')
         keep.add('oem-config')
 
-        cache = Cache()
+        cache = install_misc.shared_cache()
         # TODO cjwatson 2012-05-04: It would be nice to use a set
         # comprehension here, but that causes:
         #   SyntaxError: can not delete variable 'cache' referenced in nested
@@ -1432,8 +1541,7 @@ class Install(install_misc.InstallBase):
 
         install_misc.record_removed(remove)
         (regular, recursive) = install_misc.query_recorded_removed()
-        self.do_remove(regular)
-        self.do_remove(recursive, recursive=True)
+        self.do_remove(regular, recursive)
 
     def copy_tree(self, source, target, uid, gid):
         # Mostly stolen from copy_all.
@@ -1571,7 +1679,7 @@ class Install(install_misc.InstallBase):
                 if pkg not in keep:
                     difference.add(pkg)
 
-        cache = Cache()
+        cache = install_misc.shared_cache()
         difference -= install_misc.expand_dependencies_simple(
             cache, keep, difference)
         del cache
@@ -1599,10 +1707,11 @@ class Install(install_misc.InstallBase):
         # Don't worry about failures removing packages; it will be easier
         # for the user to sort them out with a graphical package manager (or
         # whatever) after installation than it will be to try to deal with
-        # them automatically here.
+        # them automatically here.  The restricted extras would be installed
+        # straight after this anyway, so do that in the same transaction.
         (regular, recursive) = install_misc.query_recorded_removed()
-        self.do_remove(regular)
-        self.do_remove(recursive, recursive=True)
+        self.restricted_extras_installed = self.do_remove(
+            regular, recursive, to_install=self.restricted_extras())
 
         oem_remove_extras = False
         try:
@@ -1749,7 +1858,8 @@ class Install(install_misc.InstallBase):
 
         for log_file in ('/var/log/syslog', '/var/log/partman',
                          '/var/log/installer/version', '/var/log/casper.log',
-                         '/var/log/installer/debug', '/run/casper-md5check.json'):
+                         '/var/log/installer/debug', '/run/casper-md5check.json',
+                         '/var/log/installer/copy-stats'):
             target_log_file = os.path.join(target_dir,
                                            os.path.basename(log_file))
             if os.path.isfile(log_file):
@@ -1831,6 +1941,14 @@ class Install(install_misc.InstallBase):
 
     def cleanup(self):
         """Miscellaneous cleanup tasks."""
+        try:
+            self.triggers.finish()
+        except Exception:
+            syslog.syslog(
+                syslog.LOG_WARNING, 'Could not process deferred triggers:')
+            for line in traceback.format_exc().split('\n'):
+                syslog.syslog(syslog.LOG_WARNING, line)
+
         misc.execute('umount', self.target_file('cdrom'))
 
         env = dict(os.environ)
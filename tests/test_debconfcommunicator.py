@@ -0,0 +1,147 @@
+#! /usr/bin/python3
+# -*- coding: utf-8; -*-
+
+import io
+import os
+import unittest
+
+import debconf
+import mock
+
+from ubiquity import debconfcommunicator
+
+
+class DebconfCommunicatorTests(unittest.TestCase):
+    def setUp(self):
+        for patcher in (
+                mock.patch('subprocess.Popen'),
+                mock.patch.object(debconf.Debconf, '__init__',
+                                  return_value=None),
+                mock.patch.dict(os.environ, {'LANGUAGE': 'en'})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(debconf.Debconf, 'command')
+        self.mock_command = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_command.side_effect = (
+            lambda db, command, *params: '%s %s' % (command, ' '.join(params)))
+        self.db = debconfcommunicator.DebconfCommunicator('ubiquity')
+        self.db.dccomm = None
+
+    def test_metaget_cached(self):
+        self.assertEqual('METAGET foo/bar description',
+                         self.db.command('metaget', 'foo/bar', 'description'))
+        self.db.command('METAGET', 'foo/bar', 'description')
+        self.assertEqual(1, self.mock_command.call_count)
+        self.db.command('METAGET', 'foo/bar', 'choices')
+        self.assertEqual(2, self.mock_command.call_count)
+        os.environ['LANGUAGE'] = 'fr'
+        self.db.command('METAGET', 'foo/bar', 'description')
+        self.assertEqual(3, self.mock_command.call_count)
+
+    def test_metaget_invalidated(self):
+        self.db.command('METAGET', 'foo/bar', 'description')
+        self.db.command('METAGET', 'foo/baz', 'description')
+        self.db.command('SUBST', 'foo/bar', 'KEY', 'value')
+        self.db.command('METAGET', 'foo/bar', 'description')
+        self.db.command('METAGET', 'foo/baz', 'description')
+        self.assertEqual(4, self.mock_command.call_count)
+        self.db.command('X_LOADTEMPLATEFILE', '/tmp/templates')
+        self.db.command('METAGET', 'foo/baz', 'description')
+        self.assertEqual(6, self.mock_command.call_count)
+
+    def test_metaget_errors_not_cached(self):
+        self.mock_command.side_effect = debconf.DebconfError(20, 'no')
+        for _ in range(2):
+            self.assertRaises(debconf.DebconfError, self.db.command,
+                              'METAGET', 'foo/bar', 'description')
+        self.assertEqual(2, self.mock_command.call_count)
+
+    def test_metaget_missing_cached(self):
+        self.mock_command.side_effect = debconf.DebconfError(
+            10, "foo/bar doesn't exist")
+        for _ in range(2):
+            self.assertRaises(debconf.DebconfError, self.db.command,
+                              'METAGET', 'foo/bar', 'choices')
+        self.assertEqual(1, self.mock_command.call_count)
+        self.db.read = io.StringIO('')
+        self.db.write = mock.Mock()
+        results = self.db.pipeline([('METAGET', 'foo/bar', 'choices')])
+        self.assertEqual(10, results[0].args[0])
+        self.db.write.write.assert_not_called()
+        self.mock_command.side_effect = (
+            lambda db, command, *params: '')
+        self.db.command('REGISTER', 'foo/template', 'foo/bar')
+        self.assertEqual('', self.db.command('METAGET', 'foo/bar', 'choices'))
+
+    def test_pipeline(self):
+        self.db.read = io.StringIO(
+            '0 one\n10 foo/baz doesn\'t exist\n1 two\\nlines\n0 \n')
+        self.db.write = mock.Mock()
+        self.db.command('METAGET', 'foo/cached', 'description')
+        results = self.db.pipeline([
+            ('METAGET', 'foo/bar', 'description'),
+            ('METAGET', 'foo/cached', 'description'),
+            ('GET', 'foo/baz'),
+            ('METAGET', 'foo/quux', 'extended_description'),
+            ('SET', 'foo/bar', 'value'),
+        ])
+        self.assertEqual('one', results[0])
+        self.assertEqual('METAGET foo/cached description', results[1])
+        self.assertIsInstance(results[2], debconf.DebconfError)
+        self.assertEqual('two\nlines', results[3])
+        self.assertEqual('', results[4])
+        self.db.write.write.assert_has_calls([
+            mock.call('METAGET foo/bar description\n'),
+            mock.call('GET foo/baz\n'),
+            mock.call('METAGET foo/quux extended_description\n'),
+            mock.call('SET foo/bar value\n'),
+        ])
+        self.assertEqual(4, self.db.write.write.call_count)
+        self.db.write.flush.assert_called_once_with()
+        self.assertEqual(1, self.mock_command.call_count)
+        self.assertEqual('two\nlines',
+                         self.db.command(
+                             'METAGET', 'foo/quux', 'extended_description'))
+        self.assertEqual(1, self.mock_command.call_count)
+
+    def test_pipeline_invalidates(self):
+        self.db.read = io.StringIO('0 \n0 new\n')
+        self.db.write = mock.Mock()
+        self.db.command('METAGET', 'foo/bar', 'description')
+        self.assertEqual(['', 'new'], self.db.pipeline([
+            ('SUBST', 'foo/bar', 'KEY', 'value'),
+            ('METAGET', 'foo/bar', 'description'),
+        ]))
+        self.assertEqual('new', self.db.command(
+            'METAGET', 'foo/bar', 'description'))
+
+    def test_pipeline_caches_missing(self):
+        self.db.read = io.StringIO(
+            "10 tzsetup/country/XX doesn't exist\n20 no such field\n")
+        self.db.write = mock.Mock()
+        commands = [('METAGET', 'tzsetup/country/XX', 'choices'),
+                    ('METAGET', 'foo/bar', 'choices-c')]
+        results = self.db.pipeline(commands)
+        self.assertEqual([10, 20], [e.args[0] for e in results])
+        self.db.read = io.StringIO('20 no such field\n')
+        self.db.write.reset_mock()
+        results = self.db.pipeline(commands)
+        self.assertEqual([10, 20], [e.args[0] for e in results])
+        self.db.write.write.assert_called_once_with(
+            'METAGET foo/bar choices-c\n')
+        self.assertRaises(debconf.DebconfError, self.db.command,
+                          'METAGET', 'tzsetup/country/XX', 'choices')
+        self.assertEqual(0, self.mock_command.call_count)
+
+    def test_pipeline_batches(self):
+        self.db.pipeline_depth = 2
+        self.db.read = io.StringIO('0 a\n0 b\n0 c\n')
+        self.db.write = mock.Mock()
+        self.assertEqual(['a', 'b', 'c'], self.db.pipeline(
+            [('GET', 'foo/%d' % i) for i in range(3)]))
+        self.assertEqual(2, self.db.write.flush.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
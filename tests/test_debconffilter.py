@@ -0,0 +1,117 @@
+#! /usr/bin/python3
+# -*- coding: utf-8; -*-
+
+import os
+import unittest
+
+import debconf
+import mock
+
+from ubiquity import debconffilter
+
+
+class Widget:
+    def set(self, question, value):
+        pass
+
+
+class DebconfFilterTests(unittest.TestCase):
+    def setUp(self):
+        self.db = mock.Mock()
+        self.db.metaget.side_effect = lambda question, field: (
+            'boolean' if question.endswith('/confirm') else 'string')
+        self.widget = Widget()
+        self.other = mock.Mock(spec=[])
+        self.dbfilter = debconffilter.DebconfFilter(self.db, {
+            '^foo/': self.widget,
+            'type:boolean': self.widget,
+            'PROGRESS': self.widget,
+            '^bar/': self.other,
+        })
+
+    def test_find_widgets(self):
+        self.assertEqual(
+            [self.widget], self.dbfilter.find_widgets(['foo/name']))
+        self.assertEqual(
+            [self.widget], self.dbfilter.find_widgets(['baz/x', 'PROGRESS']))
+        self.assertEqual(
+            [self.other], self.dbfilter.find_widgets(['bar/name']))
+        self.assertEqual([], self.dbfilter.find_widgets(['baz/name']))
+        self.assertEqual(
+            [self.widget], self.dbfilter.find_widgets(['foo/confirm']))
+        self.assertEqual(
+            [self.widget, self.other],
+            self.dbfilter.find_widgets(['foo/name', 'bar/name']))
+
+    def test_find_widgets_method(self):
+        self.assertEqual(
+            [self.widget], self.dbfilter.find_widgets(['foo/name'], 'set'))
+        self.assertEqual(
+            [], self.dbfilter.find_widgets(['bar/name'], 'set'))
+
+    def test_find_widgets_type(self):
+        self.assertEqual(
+            [self.widget], self.dbfilter.find_widgets(['baz/confirm']))
+        self.db.metaget.assert_called_once_with('baz/confirm', 'Type')
+        # Answers are remembered, so there's no need to ask again.
+        self.dbfilter.find_widgets(['baz/confirm'])
+        self.db.metaget.assert_called_once_with('baz/confirm', 'Type')
+
+    def test_find_widgets_type_missing_question(self):
+        self.db.metaget.side_effect = debconf.DebconfError(
+            10, "baz/confirm doesn't exist")
+        self.assertEqual([], self.dbfilter.find_widgets(['baz/confirm']))
+        # Once the question has been registered, it matches.
+        self.db.metaget.side_effect = None
+        self.db.metaget.return_value = 'boolean'
+        self.assertEqual(
+            [self.widget], self.dbfilter.find_widgets(['baz/confirm']))
+
+    def test_tryreadline(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.dbfilter.subout_fd = read_fd
+        self.dbfilter.read_size = 8
+        self.dbfilter.toread = bytearray(8)
+        os.write(write_fd, b'GET foo/name\nSET foo/name a long value\nGO')
+        os.close(write_fd)
+        self.assertEqual('GET foo/name\n', self.dbfilter.tryreadline())
+        self.assertEqual(
+            'SET foo/name a long value\n', self.dbfilter.tryreadline())
+        self.assertFalse(self.dbfilter.has_buffered_line())
+        self.assertEqual('GO', self.dbfilter.tryreadline())
+        self.assertEqual('', self.dbfilter.tryreadline())
+
+    def test_tryreadline_nonblocking(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        os.set_blocking(read_fd, False)
+        self.dbfilter.subout_fd = read_fd
+        os.write(write_fd, b'GET foo/a\nGET foo/b\nGET')
+        self.assertEqual('GET foo/a\n', self.dbfilter.tryreadline())
+        self.assertTrue(self.dbfilter.has_buffered_line())
+        self.assertEqual('GET foo/b\n', self.dbfilter.tryreadline())
+        self.assertIsNone(self.dbfilter.tryreadline())
+        os.write(write_fd, b' foo/c\n')
+        self.assertEqual('GET foo/c\n', self.dbfilter.tryreadline())
+
+    def test_process_line_coalesces_replies(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        self.dbfilter.subout_fd = read_fd
+        self.dbfilter.subin = mock.Mock()
+        self.db.command.return_value = 'value'
+        os.write(write_fd, b'GET foo/a\nGET foo/b\n')
+        self.assertTrue(self.dbfilter.process_line())
+        self.dbfilter.subin.flush.assert_not_called()
+        self.assertTrue(self.dbfilter.process_line())
+        self.assertEqual(
+            [mock.call('0 value\n'), mock.call('0 value\n')],
+            self.dbfilter.subin.write.call_args_list)
+        self.dbfilter.subin.flush.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,9 +5,10 @@ import io
 import os
 import unittest
 
+import debconf
 import mock
 
-from ubiquity import filteredcommand
+from ubiquity import debconfcommunicator, filteredcommand
 
 
 class FilteredCommandTests(unittest.TestCase):
@@ -41,3 +42,46 @@ class FilteredCommandTests(unittest.TestCase):
         variant = b"English"
         filteredcommand.UntrustedBase.debug(
             "Unknown keyboard variant %s", variant)
+
+    @mock.patch('time.monotonic')
+    def test_progress_refresh_rate(self, mock_monotonic):
+        frontend = mock.Mock()
+        command = filteredcommand.FilteredCommand(frontend, db=mock.Mock())
+        command.description = lambda template: template
+        mock_monotonic.return_value = 100.0
+        command.progress_start(0, 100, 'ubiquity/install/title')
+        self.assertEqual(1, frontend.refresh.call_count)
+        for val in range(10):
+            command.progress_set('ubiquity/install/title', val)
+        self.assertEqual(10, frontend.debconf_progress_set.call_count)
+        self.assertEqual(1, frontend.refresh.call_count)
+        mock_monotonic.return_value = 101.0
+        command.progress_set('ubiquity/install/title', 9)
+        self.assertEqual(1, frontend.refresh.call_count)
+        command.progress_set('ubiquity/install/title', 10)
+        self.assertEqual(2, frontend.refresh.call_count)
+        command.progress_stop()
+        self.assertEqual(3, frontend.refresh.call_count)
+
+    def test_preseed_pipelined(self):
+        db = mock.Mock(spec=debconfcommunicator.DebconfCommunicator)
+        # Debconf sets up its command methods in __init__.
+        for method in ('register', 'set', 'subst', 'fset'):
+            setattr(db, method, mock.Mock())
+        db.pipeline.return_value = ['', '']
+        command = filteredcommand.FilteredCommand(mock.Mock(), db=db)
+        command.preseed('foo/bar', 'value')
+        db.pipeline.assert_called_once_with(
+            [('SET', 'foo/bar', 'value'), ('FSET', 'foo/bar', 'seen', 'true')])
+        self.assertFalse(db.register.called)
+
+        db.pipeline.return_value = [
+            debconf.DebconfError(10, 'foo/baz doesn\'t exist'),
+            debconf.DebconfError(10, 'foo/baz doesn\'t exist')]
+        db.set.side_effect = [
+            debconf.DebconfError(10, 'foo/baz doesn\'t exist'), None]
+        command.preseed('foo/baz', 'value')
+        db.register.assert_called_once_with(
+            'debian-installer/dummy', 'foo/baz')
+        self.assertEqual(2, db.set.call_count)
+        db.fset.assert_called_once_with('foo/baz', 'seen', 'true')
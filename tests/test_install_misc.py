@@ -1,13 +1,62 @@
 #! /usr/bin/python3
 
+import errno
+import hashlib
 import os
+import py_compile
 import shutil
+import stat
+import sys
 import tempfile
 import unittest
 
+import debconf
+import mock
+
 from ubiquity import install_misc
 
 
+def fake_apt_cache(depends, recommends=None):
+    """Fake just enough of an apt cache for install_misc.DependencyGraph.
+
+    depends maps the name of each installed package to its Depends, as a
+    list of lists of alternative package names; recommends does the same
+    for Recommends.
+    """
+    if recommends is None:
+        recommends = {}
+    packages = {}
+    for i, name in enumerate(sorted(depends)):
+        pkg = mock.Mock(id=i)
+        pkg.get_fullname.return_value = name
+        pkg.current_ver = mock.Mock(id=i, parent_pkg=pkg)
+        packages[name] = pkg
+
+    def fake_dependency(alt):
+        if alt in packages:
+            return mock.Mock(**{
+                "target_pkg": packages[alt],
+                "all_targets.return_value": [packages[alt].current_ver]})
+        else:
+            return mock.Mock(**{
+                "target_pkg": mock.Mock(current_ver=None),
+                "all_targets.return_value": []})
+
+    for name in depends:
+        packages[name].current_ver.depends_list = {
+            key: [[fake_dependency(alt) for alt in dep_or]
+                  for dep_or in fields.get(name, [])]
+            for key, fields in (("Depends", depends),
+                                ("Recommends", recommends))}
+    cache = mock.MagicMock()
+    cache._cache.packages = list(packages.values())
+    cache._depcache.marked_delete.return_value = False
+    cache._depcache.broken_count = 0
+    apt_packages = {name: mock.Mock() for name in depends}
+    cache.__getitem__.side_effect = apt_packages.__getitem__
+    return cache, apt_packages
+
+
 class InstallMiscTests(unittest.TestCase):
     def setUp(self):
         self.source = tempfile.mkdtemp()
@@ -108,3 +157,621 @@ class InstallMiscTests(unittest.TestCase):
             self.target_path("source-file-target-non-empty-dir.bak")))
         self.assertTrue(os.path.isfile(
             self.target_path("source-file-target-non-empty-dir.bak/file")))
+
+    def test_copy_file_data(self):
+        with open(self.source_path("file"), "wb") as f:
+            f.write(b"x" * 100000)
+        self.assertTrue(install_misc.copy_file_data(
+            self.source_path("file"), self.target_path("file"), True))
+        with open(self.target_path("file"), "rb") as f:
+            self.assertEqual(b"x" * 100000, f.read())
+
+    def test_copy_metadata(self):
+        with open(self.source_path("file"), "w"):
+            pass
+        with open(self.target_path("file"), "w"):
+            pass
+        os.chmod(self.source_path("file"), 0o640)
+        os.utime(self.source_path("file"), (1000000000, 1000000000))
+        st = os.lstat(self.source_path("file"))
+        install_misc.copy_metadata(
+            self.source_path("file"), self.target_path("file"), st)
+        st_target = os.lstat(self.target_path("file"))
+        self.assertEqual(0o640, stat.S_IMODE(st_target.st_mode))
+        self.assertEqual(1000000000, st_target.st_mtime)
+
+    def test_copy_file_data_falls_back_to_buffered_copy(self):
+        with open(self.source_path("file"), "wb") as f:
+            f.write(b"x" * 100000)
+        unsupported = OSError(errno.ENOSYS, "Function not implemented")
+        with mock.patch("os.copy_file_range", side_effect=unsupported), \
+                mock.patch("os.sendfile", side_effect=unsupported), \
+                mock.patch.object(install_misc, "_copy_methods_failed",
+                                  set()) as failed:
+            self.assertTrue(install_misc.copy_file_data(
+                self.source_path("file"), self.target_path("file"), False))
+            self.assertIn("_copy_file_range",
+                          [method for method, _, _ in failed])
+        with open(self.target_path("file"), "rb") as f:
+            self.assertEqual(b"x" * 100000, f.read())
+
+    def test_copy_file_data_retries_per_file_failures(self):
+        with open(self.source_path("file"), "wb") as f:
+            f.write(b"x" * 100000)
+        invalid = OSError(errno.EINVAL, "Invalid argument")
+        with mock.patch("os.copy_file_range",
+                        side_effect=invalid) as mock_copy_file_range, \
+                mock.patch("os.sendfile", return_value=0), \
+                mock.patch.object(install_misc, "_copy_methods_failed",
+                                  set()) as failed:
+            for _ in range(2):
+                self.assertTrue(install_misc.copy_file_data(
+                    self.source_path("file"), self.target_path("file"),
+                    False))
+            self.assertNotIn("_copy_file_range",
+                             [method for method, _, _ in failed])
+            self.assertEqual(2, mock_copy_file_range.call_count)
+        with open(self.target_path("file"), "rb") as f:
+            self.assertEqual(b"x" * 100000, f.read())
+
+    def test_copy_file_data_raises_real_errors(self):
+        with open(self.source_path("file"), "wb") as f:
+            f.write(b"x" * 100000)
+        denied = OSError(errno.EPERM, "Operation not permitted")
+        with mock.patch("os.copy_file_range", side_effect=denied), \
+                mock.patch.object(install_misc, "_copy_methods_failed",
+                                  set()):
+            self.assertRaises(
+                OSError, install_misc.copy_file_data,
+                self.source_path("file"), self.target_path("file"), False)
+
+    def test_copy_buffer_size(self):
+        self.assertEqual(16 * 1024, install_misc.copy_buffer_size(0))
+        self.assertEqual(100000, install_misc.copy_buffer_size(100000))
+        self.assertEqual(
+            1024 * 1024, install_misc.copy_buffer_size(100 * 1024 * 1024))
+
+    def test_load_hash_manifest(self):
+        manifest = self.source_path("filesystem.b2sums")
+        with open(manifest, "w") as f:
+            print("%s  ./usr/bin/foo" % ("00" * 16), file=f)
+            print("%s */etc/bar" % ("ff" * 64), file=f)
+            print("garbage", file=f)
+        hashes = install_misc.load_hash_manifest(manifest)
+        self.assertEqual(
+            {"usr/bin/foo": b"\0" * 16, "etc/bar": b"\xff" * 64}, hashes)
+
+    def test_load_hash_manifest_missing(self):
+        self.assertEqual({}, install_misc.load_hash_manifest(
+            self.source_path("nonexistent")))
+
+    def test_copy_file_data_checks_expected_hash(self):
+        with open(self.source_path("file"), "wb") as f:
+            f.write(b"data")
+        good = hashlib.blake2b(b"data", digest_size=16).digest()
+        bad = hashlib.blake2b(b"atad", digest_size=16).digest()
+        for strict in (False, True):
+            self.assertTrue(install_misc.copy_file_data(
+                self.source_path("file"), self.target_path("file"), True,
+                expected=good, strict=strict))
+            self.assertFalse(install_misc.copy_file_data(
+                self.source_path("file"), self.target_path("file"), True,
+                expected=bad, strict=strict))
+
+    def test_walk_source_yields_directories_before_contents(self):
+        os.makedirs(self.source_path("a/b"))
+        with open(self.source_path("a/b/file"), "w"):
+            pass
+        os.symlink("b", self.source_path("a/link"))
+        seen = []
+        for entry in install_misc.walk_source(self.source):
+            if "/" in entry.relpath:
+                self.assertIn(os.path.dirname(entry.relpath), seen)
+            seen.append(entry.relpath)
+        self.assertEqual(["a", "a/b", "a/b/file", "a/link"], sorted(seen))
+
+    def test_copy_manifest_round_trip(self):
+        os.makedirs(self.source_path("tree/dir"))
+        with open(self.source_path("tree/dir/file"), "wb") as f:
+            f.write(b"data")
+        os.symlink("dir/file", self.source_path("tree/link"))
+        manifest = self.source_path("filesystem.copymanifest")
+        install_misc.write_copy_manifest(self.source_path("tree"), manifest)
+        total_size, entries = install_misc.read_copy_manifest(manifest)
+        entries = {entry.relpath: entry for entry in entries}
+        self.assertEqual(["dir", "dir/file", "link"], sorted(entries))
+        st = os.lstat(self.source_path("tree/dir/file"))
+        self.assertEqual(st.st_mode, entries["dir/file"].st.st_mode)
+        self.assertEqual(4, entries["dir/file"].st.st_size)
+        self.assertEqual(
+            hashlib.blake2b(b"data", digest_size=16).digest(),
+            entries["dir/file"].digest)
+        self.assertEqual("dir/file", entries["link"].linkto)
+        self.assertEqual(
+            sum(entry.st.st_size for entry in entries.values()), total_size)
+
+    def test_read_copy_manifest_missing(self):
+        self.assertIsNone(install_misc.read_copy_manifest(
+            self.source_path("nonexistent")))
+
+    def write_squashfs(self, path, mkfs_time, bytes_used):
+        with open(path, "wb") as f:
+            f.write(install_misc._squashfs_super_block.pack(
+                install_misc.SQUASHFS_MAGIC, mkfs_time, bytes_used, 0))
+            f.write(b"\0" * bytes_used)
+
+    def test_copy_manifest_squashfs_identity(self):
+        os.makedirs(self.source_path("tree/dir"))
+        squashfs = self.source_path("filesystem.squashfs")
+        self.write_squashfs(squashfs, 1000, 100)
+        manifest = self.source_path("filesystem.copymanifest")
+        install_misc.write_copy_manifest(
+            self.source_path("tree"), manifest, squashfs=squashfs)
+        self.assertIsNotNone(install_misc.read_copy_manifest(
+            manifest, squashfs=squashfs))
+        # Remastered, but with the old manifest left in place.
+        self.write_squashfs(squashfs, 2000, 100)
+        self.assertIsNone(install_misc.read_copy_manifest(
+            manifest, squashfs=squashfs))
+        os.unlink(squashfs)
+        self.assertIsNone(install_misc.read_copy_manifest(
+            manifest, squashfs=squashfs))
+
+    def test_read_copy_manifest_truncated(self):
+        os.makedirs(self.source_path("tree/dir"))
+        with open(self.source_path("tree/dir/file"), "wb") as f:
+            f.write(b"data")
+        manifest = self.source_path("filesystem.copymanifest")
+        install_misc.write_copy_manifest(self.source_path("tree"), manifest)
+        with open(manifest, "rb") as f:
+            data = f.read()
+        for length in (4, len(data) - 1):
+            with open(manifest, "wb") as f:
+                f.write(data[:length])
+            self.assertIsNone(install_misc.read_copy_manifest(manifest))
+        with open(manifest, "wb") as f:
+            f.write(data + b"\0")
+        self.assertIsNone(install_misc.read_copy_manifest(manifest))
+
+    def test_read_order_key(self):
+        with open(self.source_path("file"), "w"):
+            pass
+        st = os.lstat(self.source_path("file"))
+        self.assertIsNone(install_misc.read_order_key("walk"))
+        self.assertEqual(
+            st.st_ino,
+            install_misc.read_order_key("inode")(
+                self.source_path("file"), st))
+        # An empty file has no extents, so we fall back to the inode.
+        self.assertEqual(
+            (1, st.st_ino),
+            install_misc.read_order_key("extent")(
+                self.source_path("file"), st))
+
+    def test_files_to_skip(self):
+        info = self.source_path("info")
+        os.mkdir(info)
+        with open(os.path.join(info, "removed:amd64.list"), "w") as f:
+            print("/.\n/usr\n/usr/share\n/usr/share/removed\n"
+                  "/usr/share/removed/file\n/usr/share/shared\n"
+                  "/usr/share/shared/removed-file", file=f)
+        with open(os.path.join(info, "kept.list"), "w") as f:
+            print("/.\n/usr\n/usr/share\n/usr/share/shared\n"
+                  "/usr/share/shared/kept-file", file=f)
+        files, dirs = install_misc.files_to_skip(
+            ["removed"], admindir=self.source)
+        self.assertEqual(
+            {"usr", "usr/share", "usr/share/removed",
+             "usr/share/removed/file", "usr/share/shared",
+             "usr/share/shared/removed-file"}, files)
+        self.assertEqual({"usr/share/removed"}, dirs)
+
+    @mock.patch("subprocess.Popen")
+    def test_files_to_skip_multiarch(self, mock_popen):
+        info = self.source_path("info")
+        os.mkdir(info)
+        for arch in ("amd64", "i386"):
+            with open(os.path.join(info, "foo:%s.list" % arch), "w") as f:
+                print("/.\n/usr\n/usr/lib\n/usr/lib/%s\n"
+                      "/usr/lib/%s/libfoo.so" % (arch, arch), file=f)
+        with open(os.path.join(info, "kept.list"), "w") as f:
+            print("/.\n/usr\n/usr/lib\n/usr/lib/kept", file=f)
+        files, dirs = install_misc.files_to_skip(
+            ["foo"], admindir=self.source)
+        self.assertIn("usr/lib/amd64/libfoo.so", files)
+        self.assertIn("usr/lib/i386/libfoo.so", files)
+        self.assertEqual({"usr/lib/amd64", "usr/lib/i386"}, dirs)
+        mock_popen.assert_not_called()
+
+    def test_walk_source_prunes_directories(self):
+        os.makedirs(self.source_path("a/pruned/deeper"))
+        os.makedirs(self.source_path("a/kept"))
+        self.assertEqual(
+            ["a", "a/kept"],
+            sorted(entry.relpath for entry in install_misc.walk_source(
+                self.source, prune={"a/pruned"})))
+
+    def test_copy_file_data_copies_metadata(self):
+        with open(self.source_path("file"), "wb") as f:
+            f.write(b"data")
+        os.chmod(self.source_path("file"), 0o751)
+        os.utime(self.source_path("file"), (1000000000, 1000000000))
+        st = os.lstat(self.source_path("file"))
+        for md5_check in (False, True):
+            self.assertTrue(install_misc.copy_file_data(
+                self.source_path("file"), self.target_path("file"),
+                md5_check, st=st, xattrs=[]))
+            st_target = os.lstat(self.target_path("file"))
+            self.assertEqual(0o751, stat.S_IMODE(st_target.st_mode))
+            self.assertEqual(1000000000, st_target.st_mtime)
+
+    def test_copy_metadata_directory(self):
+        os.mkdir(self.source_path("dir"), 0o700)
+        os.mkdir(self.target_path("dir"))
+        st = os.lstat(self.source_path("dir"))
+        install_misc.copy_metadata(
+            self.source_path("dir"), self.target_path("dir"), st)
+        self.assertEqual(
+            0o700, stat.S_IMODE(os.lstat(self.target_path("dir")).st_mode))
+
+    @mock.patch("ubiquity.misc.mount_info")
+    def test_source_has_xattrs_squashfs(self, mock_mount_info):
+        device = self.source_path("filesystem.squashfs")
+        mock_mount_info.return_value = (device, "squashfs", "ro")
+        for xattr_table, expected in ((0xFFFFFFFFFFFFFFFF, False),
+                                      (4096, True)):
+            with open(device, "wb") as f:
+                f.write(install_misc._squashfs_super_block.pack(
+                    install_misc.SQUASHFS_MAGIC, 0, 0, xattr_table))
+            self.assertEqual(
+                expected, install_misc.source_has_xattrs(self.source))
+
+    def test_copy_journal_resumes(self):
+        with open(self.source_path("file"), "wb") as f:
+            f.write(b"data")
+        st = os.lstat(self.source_path("file"))
+        self.assertTrue(install_misc.copy_file_data(
+            self.source_path("file"), self.target_path("file"), False,
+            st=st, xattrs=[]))
+        journal_path = self.target_path(".journal")
+        journal = install_misc.CopyJournal(journal_path)
+        self.assertFalse(journal.completed(
+            "file", self.target_path("file"), st))
+        journal.record("file", st, b"\x01\x02")
+        journal.close()
+        # Simulate an interruption halfway through writing another entry.
+        with open(journal_path, "ab") as f:
+            f.write(b"4 0 - oth")
+
+        journal = install_misc.CopyJournal(journal_path)
+        self.assertEqual(["file"], list(journal.done))
+        self.assertTrue(journal.completed(
+            "file", self.target_path("file"), st, b"\x01\x02"))
+        self.assertFalse(journal.completed(
+            "file", self.target_path("file"), st, b"\x03\x04"))
+        os.utime(self.target_path("file"), (0, 0))
+        self.assertFalse(journal.completed(
+            "file", self.target_path("file"), st, b"\x01\x02"))
+        journal.remove()
+        self.assertFalse(os.path.exists(journal_path))
+
+    def test_writeback_manager_bounds_dirty_data(self):
+        writeback = install_misc.WritebackManager(limit=8, max_files=2)
+        for name in ("a", "b", "c"):
+            with open(self.source_path(name), "wb") as f:
+                f.write(b"data")
+            self.assertTrue(install_misc.copy_file_data(
+                self.source_path(name), self.target_path(name), False,
+                writeback=writeback))
+            self.assertLessEqual(writeback._dirty, 8)
+            self.assertLessEqual(len(writeback._pending), 2)
+        writeback.drain()
+        self.assertEqual(0, writeback._dirty)
+        self.assertEqual(0, len(writeback._pending))
+        with open(self.target_path("c"), "rb") as f:
+            self.assertEqual(b"data", f.read())
+
+    @mock.patch("ubiquity.install_misc._cache_stamp")
+    @mock.patch("ubiquity.install_misc.Cache")
+    @mock.patch("ubiquity.install_misc.apt_pkg")
+    @mock.patch.dict("ubiquity.install_misc._shared_caches", clear=True)
+    def test_shared_cache_reopens_only_when_changed(
+            self, mock_apt_pkg, mock_cache, mock_cache_stamp):
+        mock_apt_pkg.config.find_dir.return_value = "/target/"
+        mock_cache_stamp.return_value = ("status", 1)
+        cache = install_misc.shared_cache()
+        self.assertEqual(1, mock_cache.call_count)
+        self.assertIs(cache, install_misc.shared_cache())
+        cache.clear.assert_called_once_with()
+        cache.open.assert_not_called()
+        mock_cache_stamp.return_value = ("status", 2)
+        self.assertIs(cache, install_misc.shared_cache())
+        cache.open.assert_called_once_with(None)
+        self.assertEqual(1, mock_cache.call_count)
+
+    @mock.patch("ubiquity.install_misc.apt_pkg")
+    def test_cache_stamp(self, mock_apt_pkg):
+        os.makedirs(self.target_path("var/lib/dpkg"))
+        os.makedirs(self.target_path("etc/apt/apt.conf.d"))
+        paths = {
+            "Dir::State::status": self.target_path("var/lib/dpkg/status"),
+            "Dir::Etc::parts": self.target_path("etc/apt/apt.conf.d"),
+        }
+        mock_apt_pkg.config.find_file.side_effect = (
+            lambda key: paths.get(key, self.target_path("missing")))
+        mock_apt_pkg.config.find_dir.side_effect = (
+            lambda key: paths.get(key, self.target_path("missing")))
+        mock_apt_pkg.config.value_list.return_value = ["amd64"]
+        mock_apt_pkg.config.find.return_value = "amd64"
+        stamp = install_misc._cache_stamp()
+        self.assertEqual(stamp, install_misc._cache_stamp())
+
+        with open(self.target_path("var/lib/dpkg/arch"), "w") as f:
+            f.write("amd64\ni386\n")
+        self.assertNotEqual(stamp, install_misc._cache_stamp())
+        stamp = install_misc._cache_stamp()
+
+        conf = self.target_path("etc/apt/apt.conf.d/99arch")
+        with open(conf, "w") as f:
+            f.write('APT::Architectures "amd64";\n')
+        self.assertNotEqual(stamp, install_misc._cache_stamp())
+        stamp = install_misc._cache_stamp()
+        with open(conf, "a") as f:
+            f.write('APT::Architectures:: "i386";\n')
+        self.assertNotEqual(stamp, install_misc._cache_stamp())
+        stamp = install_misc._cache_stamp()
+
+        mock_apt_pkg.config.value_list.return_value = ["amd64", "i386"]
+        self.assertNotEqual(stamp, install_misc._cache_stamp())
+
+    def test_bytecode_is_current(self):
+        python = "python%d.%d" % sys.version_info[:2]
+        path = self.target_path("module.py")
+        with open(path, "w") as f:
+            f.write("x = 1\n")
+        self.assertFalse(install_misc.bytecode_is_current(path, python))
+        py_compile.compile(path, doraise=True)
+        self.assertTrue(install_misc.bytecode_is_current(path, python))
+        os.utime(path, (0, 0))
+        self.assertFalse(install_misc.bytecode_is_current(path, python))
+
+    def test_archive_hashes(self):
+        changes = []
+        for name, version, arch, marked_delete in (
+                ("libfoo1", "1:2.0-1", "amd64", False),
+                ("foo-data", "2.0_rc1", "all", False),
+                ("bar", "1.0", "amd64", True)):
+            pkg = mock.Mock(shortname=name, marked_delete=marked_delete)
+            pkg.candidate.version = version
+            pkg.candidate.architecture = arch
+            pkg.candidate.sha256 = "sum-%s" % name
+            changes.append(pkg)
+        cache = mock.Mock()
+        cache.get_changes.return_value = changes
+        self.assertEqual({
+            "libfoo1_1%3a2.0-1_amd64": "sum-libfoo1",
+            "foo-data_2.0%5frc1_all": "sum-foo-data",
+        }, install_misc.archive_hashes(cache))
+
+    def test_verify_archive(self):
+        path = self.target_path("foo_1.0_all.deb")
+        with open(path, "wb") as f:
+            f.write(b"archive")
+        sha256 = hashlib.sha256(b"archive").hexdigest()
+        install_misc.verify_archive(path, 7, sha256)
+        install_misc.verify_archive(path, 7)
+        self.assertRaises(
+            IOError, install_misc.verify_archive, path, 7, "0" * 64)
+        self.assertFalse(os.path.exists(path))
+
+    @mock.patch("ubiquity.install_misc.copy_file_data")
+    def test_copy_file_asks_before_retrying(self, mock_copy_file_data):
+        mock_copy_file_data.side_effect = [False, True]
+        db = mock.Mock()
+        db.get.return_value = "retry"
+        install_misc.copy_file(db, "source", "target", True)
+        db.subst.assert_called_once_with(
+            "ubiquity/install/copying_error/md5", "FILE", "target")
+        self.assertEqual(2, mock_copy_file_data.call_count)
+
+        mock_copy_file_data.reset_mock()
+        mock_copy_file_data.side_effect = None
+        mock_copy_file_data.return_value = False
+        db.get.return_value = "skip"
+        install_misc.copy_file(db, "source", "target", True)
+        self.assertEqual(1, mock_copy_file_data.call_count)
+
+    def test_acquire_progress_on_done(self):
+        progress = install_misc.DebconfAcquireProgress(
+            mock.Mock(), "title", None, "info")
+        progress.on_done = mock.Mock()
+        item = mock.Mock()
+        item.owner.destfile = self.target_path("foo_1.0_all.deb")
+        progress.done(item)
+        progress.on_done.assert_not_called()
+        with open(item.owner.destfile, "wb") as f:
+            f.write(b"archive")
+        progress.done(item)
+        progress.on_done.assert_called_once_with(item)
+
+    @mock.patch("ubiquity.install_misc.record_installed")
+    @mock.patch("ubiquity.install_misc.get_cache_pkg")
+    @mock.patch("ubiquity.install_misc.shared_cache")
+    @mock.patch("ubiquity.osextras.find_on_path")
+    @mock.patch("subprocess.Popen")
+    def test_select_language_packs(self, mock_popen, mock_find_on_path,
+                                   mock_shared_cache, mock_get_cache_pkg,
+                                   mock_record_installed):
+        answers = {
+            "pkgsel/language-packs": "de_DE.UTF-8, fr_FR.UTF-8",
+            "pkgsel/language-pack-patterns": "",
+            "pkgsel/install-language-support": "true",
+            "ubiquity/minimal_install": "false",
+        }
+
+        def db_get(question):
+            try:
+                return answers[question]
+            except KeyError:
+                raise debconf.DebconfError(10, question)
+
+        def check_language_support(args, **kwargs):
+            process = mock.Mock()
+            process.communicate.return_value = (
+                "support-%s\n" % args[2], None)
+            return process
+
+        mock_find_on_path.return_value = "/usr/bin/check-language-support"
+        mock_popen.side_effect = check_language_support
+        mock_get_cache_pkg.return_value.is_installed = False
+        install = install_misc.InstallBase()
+        install.db = mock.Mock()
+        install.db.get.side_effect = db_get
+        self.assertEqual([
+            "language-pack-de", "support-de_DE",
+            "language-pack-fr", "support-fr_FR",
+        ], install.select_language_packs())
+        self.assertEqual(2, mock_popen.call_count)
+
+    @mock.patch("ubiquity.install_misc.umount")
+    @mock.patch("ubiquity.install_misc.mount")
+    @mock.patch.dict("ubiquity.install_misc._chroots", clear=True)
+    def test_chroot_setup_nests(self, mock_mount, mock_umount):
+        for directory in ("usr/sbin", "sbin", "proc", "sys"):
+            os.makedirs(self.target_path(directory))
+        policy_rc_d = self.target_path("usr/sbin/policy-rc.d")
+        with install_misc.chroot(self.target):
+            self.assertTrue(os.path.exists(policy_rc_d))
+            mounts = mock_mount.call_count
+            self.assertEqual(4, mounts)
+            install_misc.chroot_setup(self.target)
+            install_misc.chroot_cleanup(self.target)
+            self.assertEqual(mounts, mock_mount.call_count)
+            mock_umount.assert_not_called()
+            self.assertTrue(os.path.exists(policy_rc_d))
+        self.assertEqual(4, mock_umount.call_count)
+        self.assertFalse(os.path.exists(policy_rc_d))
+        self.assertFalse(os.path.exists(
+            self.target_path("sbin/start-stop-daemon")))
+
+    @mock.patch("ubiquity.install_misc.chroot_cleanup")
+    @mock.patch("ubiquity.install_misc.chroot_setup")
+    @mock.patch("ubiquity.install_misc.chrex", return_value=True)
+    @mock.patch("ubiquity.install_misc.apt_pkg")
+    def test_trigger_deferral(
+            self, mock_apt_pkg, mock_chrex, mock_setup, mock_cleanup):
+        for directory in ("etc/apt/apt.conf.d", "usr/sbin", "var/tmp",
+                          "boot"):
+            os.makedirs(self.target_path(directory))
+        triggers = install_misc.TriggerDeferral(self.target)
+        triggers.start()
+        mock_apt_pkg.config.set.assert_any_call("DPkg::NoTriggers", "true")
+        self.assertTrue(os.path.exists(
+            self.target_path("etc/apt/apt.conf.d/00DeferTriggers")))
+        with open(self.target_path("usr/sbin/update-initramfs")) as f:
+            self.assertIn("/var/tmp/ubiquity-deferred-initramfs", f.read())
+
+        # Imitate what the stub records as packages are configured.
+        requests = self.target_path("var/tmp/ubiquity-deferred-initramfs")
+        with open(requests, "w") as f:
+            f.write("-c -k 1.0\n-c -k 2.0\n-u\n-u\n")
+        open(self.target_path("boot/initrd.img-2.0"), "w").close()
+        triggers.initramfs("-c", "-k", "1.0")
+        mock_chrex.assert_called_with(
+            self.target, "/usr/sbin/update-initramfs.distrib",
+            "-c", "-k", "1.0")
+
+        mock_chrex.reset_mock()
+        self.assertFalse(triggers.finish())
+        self.assertEqual([
+            mock.call(self.target, "dpkg", "--triggers-only", "--pending"),
+            mock.call(self.target, "dpkg-divert", "--package", "ubiquity",
+                      "--rename", "--quiet", "--remove",
+                      "/usr/sbin/update-initramfs"),
+            mock.call(self.target, "update-initramfs", "-u", "-k", "all"),
+        ], mock_chrex.call_args_list)
+        self.assertFalse(os.path.exists(requests))
+        self.assertFalse(os.path.exists(
+            self.target_path("etc/apt/apt.conf.d/00DeferTriggers")))
+        mock_setup.assert_called_once_with(self.target)
+        mock_cleanup.assert_called_once_with(self.target)
+
+    @mock.patch("ubiquity.install_misc.chrex", return_value=False)
+    @mock.patch("ubiquity.install_misc.apt_pkg")
+    def test_trigger_deferral_divert_fails(self, mock_apt_pkg, mock_chrex):
+        for directory in ("etc/apt/apt.conf.d", "usr/sbin", "var/tmp"):
+            os.makedirs(self.target_path(directory))
+        update_initramfs = self.target_path("usr/sbin/update-initramfs")
+        with open(update_initramfs, "w") as f:
+            f.write("real")
+        triggers = install_misc.TriggerDeferral(self.target)
+        self.assertFalse(triggers.start())
+        self.assertFalse(triggers.active)
+        with open(update_initramfs) as f:
+            self.assertEqual("real", f.read())
+        mock_apt_pkg.config.set.assert_not_called()
+        self.assertFalse(os.path.exists(
+            self.target_path("etc/apt/apt.conf.d/00DeferTriggers")))
+        self.assertFalse(triggers.finish())
+        self.assertTrue(os.path.exists(update_initramfs))
+
+
+class DependencyGraphTests(unittest.TestCase):
+    def setUp(self):
+        # a needs b; c needs b or d; e needs c.
+        self.cache, self.apt_packages = fake_apt_cache({
+            "a": [["b"]], "b": [], "c": [["b", "d"]], "d": [],
+            "e": [["c"], ["missing"]]})
+
+    def names(self, graph, ids):
+        return sorted(graph.names[i] for i in ids)
+
+    def test_removal_closure(self):
+        graph = install_misc.dependency_graph(self.cache)
+        removal = graph.removal()
+        self.assertEqual(
+            ["a", "b"],
+            self.names(graph, removal.closure(graph.lookup(["b"]))))
+        self.assertEqual(
+            ["a", "b", "c", "d", "e"],
+            self.names(graph, removal.closure(graph.lookup(["b", "d"]))))
+        removal.remove(graph.lookup(["d"]))
+        self.assertEqual(
+            ["a", "b", "c", "e"],
+            self.names(graph, removal.closure(graph.lookup(["b"]))))
+
+    def test_dependency_graph_reused_until_reopened(self):
+        graph = install_misc.dependency_graph(self.cache)
+        self.assertIs(graph, install_misc.dependency_graph(self.cache))
+        self.cache._cache = mock.Mock(packages=[])
+        self.assertIsNot(graph, install_misc.dependency_graph(self.cache))
+
+    def test_get_remove_list(self):
+        self.assertEqual(
+            set(), install_misc.get_remove_list(self.cache, ["b"]))
+        self.assertEqual(
+            {"a", "b"}, install_misc.get_remove_list(self.cache, ["a", "b"]))
+        self.assertEqual(
+            {"a", "b"},
+            install_misc.get_remove_list(self.cache, ["b"], recursive=True))
+        self.apt_packages["b"].mark_delete.assert_called_with(
+            auto_fix=False, purge=True)
+        self.apt_packages["c"].mark_delete.assert_not_called()
+
+    def test_expand_dependencies_simple(self):
+        cache, _ = fake_apt_cache(
+            {"a": [["missing", "b"]], "b": [["c"]], "c": [], "d": [],
+             "e": [["d"]]},
+            recommends={"b": [["d"]]})
+        self.assertEqual(
+            {"a", "b", "c", "d"},
+            install_misc.expand_dependencies_simple(
+                cache, ["a"], ["b", "c", "d", "e"]))
+        self.assertEqual(
+            {"a", "b", "c"},
+            install_misc.expand_dependencies_simple(
+                cache, ["a"], ["b", "c", "d", "e"], recommends=False))
+        # Dependencies are only followed through packages in to_remove.
+        self.assertEqual(
+            {"a"},
+            install_misc.expand_dependencies_simple(cache, ["a"], ["c"]))
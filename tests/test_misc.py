@@ -4,6 +4,7 @@ import grp
 import io
 import os
 import pwd
+import syslog
 from test.support import EnvironmentVarGuard, run_unittest
 import unittest
 
@@ -149,6 +150,24 @@ class MiscTests(unittest.TestCase):
         self.assertEqual(misc.debconf_escape('\\A test string\n'),
                          '\\\\A\\ test\\ string\\n')
 
+    @mock.patch('syslog.syslog')
+    def test_execute_logs_output(self, mock_syslog):
+        self.assertTrue(misc.execute('sh', '-c', 'echo out; echo err >&2'))
+        self.assertIn(mock.call(syslog.LOG_NOTICE, 'out'),
+                      mock_syslog.call_args_list)
+        self.assertIn(mock.call(syslog.LOG_NOTICE, 'err'),
+                      mock_syslog.call_args_list)
+        priority, message = mock_syslog.call_args[0]
+        self.assertEqual(syslog.LOG_INFO, priority)
+        self.assertTrue(message.startswith('sh -c echo out; echo err >&2 '
+                                           '(exit 0, '))
+
+    @mock.patch('syslog.syslog')
+    def test_execute_failure(self, mock_syslog):
+        self.assertFalse(misc.execute('false'))
+        self.assertEqual(syslog.LOG_ERR, mock_syslog.call_args[0][0])
+        self.assertFalse(misc.execute('/nonexistent/command'))
+
     @mock.patch('ubiquity.gsettings.set_list')
     @mock.patch('ubiquity.misc.execute')
     def test_set_indicator_keymaps_english(self, mock_execute, mock_set_list):
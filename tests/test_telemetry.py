@@ -0,0 +1,50 @@
+#! /usr/bin/python3
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ubiquity import telemetry
+
+
+class CopyStatsTests(unittest.TestCase):
+    def make_timer(self, **phases):
+        timer = telemetry.CopyTimer()
+        timer.phases = phases
+        timer.last = timer.start + sum(phases.values())
+        return timer
+
+    def test_summary(self):
+        stats = telemetry.CopyStats()
+        for i in range(1, 101):
+            stats.add(self.make_timer(read=i / 1000.0, write=0.001), 10)
+        stats.add(self.make_timer(metadata=0.5), regular=False)
+        stats.finish()
+        summary = stats.summary()
+        self.assertEqual(100, summary['Files'])
+        self.assertEqual(1, summary['OtherItems'])
+        self.assertEqual(1000, summary['Bytes'])
+        self.assertAlmostEqual(5.05, summary['PhaseSeconds']['read'])
+        self.assertAlmostEqual(0.1, summary['PhaseSeconds']['write'])
+        self.assertAlmostEqual(0.5, summary['PhaseSeconds']['metadata'])
+        self.assertAlmostEqual(0.051, summary['FileLatency']['p50'])
+        self.assertAlmostEqual(0.1, summary['FileLatency']['p99'])
+        self.assertAlmostEqual(0.101, summary['FileLatency']['max'])
+
+    def test_summary_empty(self):
+        summary = telemetry.CopyStats().summary()
+        self.assertEqual(0, summary['Files'])
+        self.assertEqual(0.0, summary['FileLatency']['p90'])
+
+    def test_save(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'installer', 'copy-stats')
+        stats = telemetry.CopyStats()
+        stats.add(self.make_timer(read=0.1), 42)
+        stats.finish()
+        stats.save(path)
+        with open(path) as f:
+            self.assertEqual(42, json.load(f)['Bytes'])
@@ -18,6 +18,8 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import fcntl
+import os
+import re
 import subprocess
 
 import debconf
@@ -26,7 +28,20 @@ from ubiquity import misc
 
 
 class DebconfCommunicator(debconf.Debconf):
+    # Commands after which METAGET may give different answers for the
+    # question named by the given parameter, or (for None) for any question.
+    template_changes = {
+        'DATA': None,
+        'PURGE': None,
+        'REGISTER': 1,
+        'SUBST': 0,
+        'UNREGISTER': 0,
+        'X_LOADTEMPLATEFILE': None,
+    }
+
     def __init__(self, owner, title=None, cloexec=False, env=None):
+        # question => {(field, language): value}
+        self.template_cache = {}
         self.dccomm = subprocess.Popen(
             ['debconf-communicate', '-fnoninteractive', owner],
             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
@@ -39,6 +54,134 @@ class DebconfCommunicator(debconf.Debconf):
             fcntl.fcntl(self.read.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
             fcntl.fcntl(self.write.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
 
+    # pipeline() reads replies after sending at most this many commands, so
+    # that neither side can block on a full pipe.
+    pipeline_depth = 64
+
+    # debconf's status code for a question or template that doesn't exist.
+    # Pages look up plenty of those, so METAGET failures with this status
+    # are cached along with the answers.
+    missing_status = 10
+
+    @classmethod
+    def _cacheable_error(cls, e):
+        return bool(e.args) and e.args[0] == cls.missing_status
+
+    @staticmethod
+    def _template_key(field):
+        return (field, os.environ.get('LANGUAGE', ''))
+
+    def _forget_templates(self, command, params):
+        if command in self.template_changes:
+            index = self.template_changes[command]
+            if index is None:
+                self.template_cache.clear()
+            elif len(params) > index:
+                self.template_cache.pop(params[index], None)
+
+    def command(self, command, *params):
+        """Send a command to debconf-communicate, caching METAGET.
+
+        Pages make a great many METAGET requests for descriptions and
+        choices when building their lists, but template metadata rarely
+        changes.  We remember the answers for each language, including
+        which questions don't exist, and forget them whenever a command
+        might have changed them.
+        """
+        command = command.upper()
+        if command == 'METAGET' and len(params) == 2:
+            question, field = params
+            fields = self.template_cache.setdefault(question, {})
+            key = self._template_key(field)
+            try:
+                value = fields[key]
+            except KeyError:
+                try:
+                    value = debconf.Debconf.command(self, command, *params)
+                except debconf.DebconfError as e:
+                    if self._cacheable_error(e):
+                        fields[key] = e
+                    raise
+                fields[key] = value
+                return value
+            if isinstance(value, debconf.DebconfError):
+                raise debconf.DebconfError(*value.args)
+            return value
+
+        self._forget_templates(command, params)
+        return debconf.Debconf.command(self, command, *params)
+
+    def pipeline(self, commands):
+        """Send several commands at once, and return their results in order.
+
+        Each element of commands is a sequence of a command name followed
+        by its parameters.  debconf-communicate deals with commands in the
+        order it receives them, so rather than waiting for each reply
+        before sending the next command we send a batch and then read all
+        the replies, saving a round trip per command.  A command that fails
+        has its DebconfError in place of its result rather than raising it.
+        """
+        results = []
+        batch = []
+        for command in commands:
+            command, params = command[0].upper(), command[1:]
+            if command == 'METAGET' and len(params) == 2:
+                try:
+                    value = self.template_cache[params[0]][
+                        self._template_key(params[1])]
+                except KeyError:
+                    pass
+                else:
+                    if isinstance(value, debconf.DebconfError):
+                        value = debconf.DebconfError(*value.args)
+                    results.append(value)
+                    continue
+            else:
+                self._forget_templates(command, params)
+            batch.append((len(results), command, params))
+            results.append(None)
+            if len(batch) >= self.pipeline_depth:
+                self._pipeline_batch(batch, results)
+                batch = []
+        self._pipeline_batch(batch, results)
+        return results
+
+    def _pipeline_batch(self, batch, results):
+        if not batch:
+            return
+        for _, command, params in batch:
+            self.write.write(
+                '%s %s\n' % (command, ' '.join(map(str, params))))
+        self.write.flush()
+        for index, command, params in batch:
+            try:
+                results[index] = self._reply(self.read.readline())
+            except debconf.DebconfError as e:
+                results[index] = e
+                if command != 'METAGET' or not self._cacheable_error(e):
+                    continue
+            # Apply cache updates in order, in case a later command in the
+            # batch changed a template we asked about earlier.
+            if command == 'METAGET' and len(params) == 2:
+                self.template_cache.setdefault(params[0], {})[
+                    self._template_key(params[1])] = results[index]
+            else:
+                self._forget_templates(command, params)
+
+    @staticmethod
+    def _reply(line):
+        """Parse a reply line in the same way as Debconf.command."""
+        status, _, data = line.rstrip('\n').partition(' ')
+        status = int(status)
+        if status == 0:
+            return data
+        elif status == 1:
+            return re.sub(r'\\(.)',
+                          lambda m: '\n' if m.group(1) == 'n' else m.group(1),
+                          data)
+        else:
+            raise debconf.DebconfError(status, data)
+
     def shutdown(self):
         if self.dccomm is not None:
             self.dccomm.stdout.close()
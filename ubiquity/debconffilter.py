@@ -86,6 +86,10 @@ valid_commands = {
 
 
 class DebconfFilter:
+    # Initial size of the buffer for reading from the confmodule; it grows
+    # if a single line is longer than this.
+    read_size = 65536
+
     def __init__(self, db, widgets={}, automatic=False):
         self.db = db
         self.widgets = widgets
@@ -97,9 +101,15 @@ class DebconfFilter:
         self.escaping = False
         self.progress_cancel = False
         self.progress_bars = []
-        self.toread = b''
+        # Output read from the confmodule.  Bytes from toreadpos to
+        # toreadend have not been consumed yet, and there is no newline
+        # before toscanpos.
+        self.toread = bytearray(self.read_size)
         self.toreadpos = 0
+        self.toreadend = 0
+        self.toscanpos = 0
         self.question_type_cache = {}
+        self.compile_widgets()
 
     def debug_enabled(self, key):
         if key == 'filter' and os.environ.get('UBIQUITY_DEBUG_CORE') == '1':
@@ -116,34 +126,51 @@ class DebconfFilter:
             print("%s debconf (%s): %s" % (time_str, key, ' '.join(args)),
                   file=sys.stderr)
 
+    def has_buffered_line(self):
+        """Has a complete line already been read but not yet processed?"""
+        return self.toread.find(
+            b'\n', self.toscanpos, self.toreadend) != -1
+
     # Returns None if non-blocking and can't read a full line right now;
     # returns '' at end of file; otherwise as fileobj.readline().
     def tryreadline(self):
-        ret = b''
         while True:
-            newlinepos = self.toread.find(b'\n', self.toreadpos)
+            newlinepos = self.toread.find(
+                b'\n', self.toscanpos, self.toreadend)
             if newlinepos != -1:
                 ret = self.toread[self.toreadpos:newlinepos + 1]
-                self.toreadpos = newlinepos + 1
-                if self.toreadpos >= len(self.toread):
-                    self.toread = b''
-                    self.toreadpos = 0
+                self.toreadpos = self.toscanpos = newlinepos + 1
                 break
+            self.toscanpos = self.toreadend
+
+            # Move any partial line to the start of the buffer, and grow
+            # the buffer if that line fills it.
+            pending = self.toreadend - self.toreadpos
+            if self.toreadpos:
+                self.toread[:pending] = \
+                    self.toread[self.toreadpos:self.toreadend]
+                self.toreadpos = 0
+                self.toreadend = self.toscanpos = pending
+            if pending == len(self.toread):
+                self.toread.extend(bytes(len(self.toread)))
 
             try:
-                text = os.read(self.subout_fd, 512)
-                if text == b'':
-                    ret = self.toread
-                    self.toread = b''
-                    self.toreadpos = 0
-                    break
-                self.toread += text
+                count = os.readv(
+                    self.subout_fd,
+                    [memoryview(self.toread)[self.toreadend:]])
             except OSError as e:
                 if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
                     return None
                 else:
                     raise
+            if count == 0:
+                ret = self.toread[self.toreadpos:self.toreadend]
+                self.toreadpos = self.toreadend = self.toscanpos = 0
+                break
+            self.toreadend += count
 
+        if self.toreadpos == self.toreadend:
+            self.toreadpos = self.toreadend = self.toscanpos = 0
         return ret.decode()
 
     def reply(self, code, text='', log=False):
@@ -153,8 +180,8 @@ class DebconfFilter:
         ret = '%d %s' % (code, text)
         if log:
             self.debug('filter', '-->', ret)
+        # process_line flushes once it has dealt with everything buffered.
         self.subin.write('%s\n' % ret)
-        self.subin.flush()
 
     def question_type(self, question):
         try:
@@ -163,30 +190,83 @@ class DebconfFilter:
             try:
                 qtype = self.db.metaget(question, 'Type')
             except debconf.DebconfError:
-                qtype = ''
+                # The question may not have been registered yet, so ask
+                # again next time.
+                return ''
             self.question_type_cache[question] = qtype
             return qtype
 
+    def compile_widgets(self):
+        """Prepare to match questions against self.widgets.
+
+        find_widgets is called for nearly every command the confmodule
+        sends, so each widget's patterns are combined into a single regex
+        once here, and find_widgets remembers its answers.  Call this
+        again if self.widgets changes.
+        """
+        patterns = {}
+        for pattern, widget in self.widgets.items():
+            patterns.setdefault(widget, []).append(pattern)
+        self.widget_matchers = []
+        for widget, widget_patterns in patterns.items():
+            regexes = []
+            types = set()
+            for pattern in widget_patterns:
+                if pattern.startswith('type:'):
+                    types.add(pattern[5:])
+                else:
+                    regexes.append(pattern)
+            self.widget_matchers.append((
+                widget,
+                self._combine(regexes),
+                self._combine(widget_patterns) if types else None,
+                types))
+        self.found_widgets = {}
+
+    @staticmethod
+    def _combine(patterns):
+        if not patterns:
+            return None
+        return re.compile('|'.join('(?:%s)' % p for p in patterns))
+
+    def _question_matches(self, question, regex, all_regex, types):
+        # type: patterns match questions with that template type; they
+        # are only treated as regular expressions for pseudo-questions
+        # such as CAPB or PROGRESS.  Return None rather than False if we
+        # couldn't find out the question's type, since it might match once
+        # the question exists.
+        known = True
+        if types and '/' in question:
+            if self.question_type(question) in types:
+                return True
+            known = question in self.question_type_cache
+        elif types:
+            return all_regex.search(question) is not None
+        if regex is not None and regex.search(question) is not None:
+            return True
+        return False if known else None
+
     def find_widgets(self, questions, method=None):
-        found = set()
-        for pattern in self.widgets.keys():
-            widget = self.widgets[pattern]
-            if widget not in found:
-                for question in questions:
-                    matches = False
-                    if pattern.startswith('type:') and '/' in question:
-                        try:
-                            qtype = self.question_type(question)
-                            if qtype == pattern[5:]:
-                                matches = True
-                        except debconf.DebconfError:
-                            pass
-                    elif re.search(pattern, question):
-                        matches = True
-                    if matches:
-                        if method is None or hasattr(widget, method):
-                            found.add(widget)
-                            break
+        key = (tuple(questions), method)
+        try:
+            return self.found_widgets[key]
+        except KeyError:
+            pass
+        found = []
+        memoise = True
+        for widget, regex, all_regex, types in self.widget_matchers:
+            if method is not None and not hasattr(widget, method):
+                continue
+            for question in questions:
+                matches = self._question_matches(
+                    question, regex, all_regex, types)
+                if matches is None:
+                    memoise = False
+                elif matches:
+                    found.append(widget)
+                    break
+        if memoise:
+            self.found_widgets[key] = found
         return list(found)
 
     def start(self, command, blocking=True, extra_env={}):
@@ -228,6 +308,16 @@ class DebconfFilter:
         self.db.capb('escape')
 
     def process_line(self):
+        try:
+            return self._process_line()
+        finally:
+            # The confmodule normally waits for each reply before sending
+            # anything else, but if it got ahead of us then we can send
+            # all the replies at once.
+            if self.subin is not None and not self.has_buffered_line():
+                self.subin.flush()
+
+    def _process_line(self):
         line = self.tryreadline()
         if line is None:
             return True
@@ -439,6 +529,7 @@ class DebconfFilter:
         return True
 
     def wait(self):
+        self.toreadpos = self.toreadend = self.toscanpos = 0
         if self.subin is not None and self.subout is not None:
             self.subin.close()
             self.subin = None
@@ -22,10 +22,12 @@ import os
 import signal
 import subprocess
 import sys
+import time
 
 import debconf
 
 from ubiquity import misc
+from ubiquity.debconfcommunicator import DebconfCommunicator
 from ubiquity.debconffilter import DebconfFilter
 
 
@@ -38,6 +40,15 @@ DEBCONF_IO_OUT = 2
 DEBCONF_IO_ERR = 4
 DEBCONF_IO_HUP = 8
 
+# Progress bars are repainted at most this many times a second.  Commands
+# such as the file copy send far more updates than that, and each repaint
+# takes CPU time away from the work being reported on.
+try:
+    PROGRESS_REFRESH_RATE = float(
+        os.environ.get('UBIQUITY_PROGRESS_REFRESH_RATE', 20))
+except ValueError:
+    PROGRESS_REFRESH_RATE = 20.0
+
 
 class UntrustedBase(object):
     def get(self, attr):
@@ -251,8 +262,13 @@ class FilteredCommand(UntrustedBase):
         call_again = True
 
         if condition & DEBCONF_IO_IN:
-            if not self.process_line():
-                call_again = False
+            # Lines that have already been read won't wake us up again.
+            while True:
+                if not self.process_line():
+                    call_again = False
+                    break
+                if not self.dbfilter.has_buffered_line():
+                    break
 
         if (condition & DEBCONF_IO_ERR) or (condition & DEBCONF_IO_HUP):
             call_again = False
@@ -326,6 +342,17 @@ class FilteredCommand(UntrustedBase):
         return misc.utf8(self.db.metaget(question, 'extended_description'),
                          errors='replace')
 
+    def prefetch_templates(self, questions, fields=('choices', 'choices-c')):
+        """Fetch template fields for many questions in a single batch.
+
+        Later choices() and description() calls for these questions are
+        then answered from the database's template cache.  This does
+        nothing unless the database can pipeline commands.
+        """
+        if isinstance(self.db, DebconfCommunicator):
+            self.db.pipeline([('METAGET', question, field)
+                              for question in questions for field in fields])
+
     def translate_to_c(self, question, value):
         choices = self.choices(question)
         choices_c = self.choices_untranslated(question)
@@ -345,6 +372,19 @@ class FilteredCommand(UntrustedBase):
     def preseed(self, name, value, seen=True):
         value = misc.debconf_escape(value)
 
+        if isinstance(self.db, DebconfCommunicator):
+            # The question almost always exists already, so send SET and
+            # FSET together and only fall back if the SET failed.
+            commands = [('SET', name, value)]
+            if seen:
+                commands.append(('FSET', name, 'seen', 'true'))
+            results = self.db.pipeline(commands)
+            if not isinstance(results[0], debconf.DebconfError):
+                for result in results[1:]:
+                    if isinstance(result, debconf.DebconfError):
+                        raise result
+                return
+
         try:
             self.db.set(name, value)
         except debconf.DebconfError:
@@ -432,27 +472,44 @@ class FilteredCommand(UntrustedBase):
         return self.succeeded
 
     # Default progress bar handling: just pass it through to the frontend.
+    # The frontend always hears about every change, but we only give it a
+    # chance to repaint now and again; its main loop catches up with
+    # anything we skip as soon as it is idle.
+
+    progress_val = None
+    progress_refreshed = 0
+
+    def refresh_progress(self, force=False):
+        now = time.monotonic()
+        if (force or PROGRESS_REFRESH_RATE <= 0 or
+                now - self.progress_refreshed >= 1 / PROGRESS_REFRESH_RATE):
+            self.progress_refreshed = now
+            self.frontend.refresh()
 
     def progress_start(self, progress_min, progress_max, progress_title):
         self.frontend.debconf_progress_start(
             progress_min, progress_max, self.description(progress_title))
-        self.frontend.refresh()
+        self.progress_val = None
+        self.refresh_progress(force=True)
 
     def progress_set(self, unused_progress_title, progress_val):
         ret = self.frontend.debconf_progress_set(progress_val)
-        self.frontend.refresh()
+        if progress_val != self.progress_val:
+            self.progress_val = progress_val
+            self.refresh_progress()
         return ret
 
     def progress_step(self, unused_progress_title, progress_inc):
         ret = self.frontend.debconf_progress_step(progress_inc)
-        self.frontend.refresh()
+        self.progress_val = None
+        self.refresh_progress()
         return ret
 
     def progress_info(self, unused_progress_title, progress_info):
         try:
             ret = self.frontend.debconf_progress_info(
                 self.description(progress_info))
-            self.frontend.refresh()
+            self.refresh_progress()
             return ret
         except debconf.DebconfError:
             # ignore unknown info templates
@@ -460,7 +517,8 @@ class FilteredCommand(UntrustedBase):
 
     def progress_stop(self):
         self.frontend.debconf_progress_stop()
-        self.frontend.refresh()
+        self.progress_val = None
+        self.refresh_progress(force=True)
 
     def progress_region(self, unused_progress_title,
                         progress_region_start, progress_region_end):
@@ -20,6 +20,11 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import array
+from collections import deque, namedtuple
+import concurrent.futures
+import contextlib
+import ctypes
 import errno
 import fcntl
 import hashlib
@@ -28,9 +33,11 @@ import re
 import select
 import shutil
 import stat
+import struct
 import subprocess
 import sys
 import syslog
+import threading
 import traceback
 
 from apt.cache import Cache
@@ -68,7 +75,7 @@ def reconfigure_preexec():
 def reconfigure(target, package):
     """executes a dpkg-reconfigure into installed system to each
     package which provided by args."""
-    subprocess.call(['log-output', '-t', 'ubiquity', 'chroot', target,
+    misc.run_logged(['chroot', target,
                      'dpkg-reconfigure', '-fnoninteractive', package],
                     preexec_fn=reconfigure_preexec, close_fds=True)
 
@@ -78,6 +85,44 @@ def chrex(target, *args):
     return misc.execute('chroot', target, *args)
 
 
+def bytecode_is_current(path, python):
+    """Does the Python source file path have up-to-date bytecode?
+
+    python is the name of the interpreter that would compile it, such as
+    python2.7 or python3.12.  We only understand timestamp-based bytecode;
+    anything else is assumed to need compiling again.
+    """
+    version = tuple(int(part) for part in python[6:].split('.'))
+    if version < (3,):
+        bytecode = path + 'c'
+        header = struct.Struct('<4xI')
+    else:
+        dirname, basename = os.path.split(path)
+        bytecode = os.path.join(
+            dirname, '__pycache__', '%s.cpython-%s.pyc' % (
+                os.path.splitext(basename)[0],
+                ''.join(str(part) for part in version)))
+        if version < (3, 7):
+            header = struct.Struct('<4xII')
+        else:
+            header = struct.Struct('<4xIII')
+    try:
+        st = os.stat(path)
+        with open(bytecode, 'rb') as bytecode_file:
+            fields = header.unpack(bytecode_file.read(header.size))
+    except (OSError, struct.error):
+        return False
+    if len(fields) == 3:
+        flags, fields = fields[0], fields[1:]
+        if flags != 0:
+            # Hash-based bytecode.
+            return False
+    mtime = int(st.st_mtime) & 0xFFFFFFFF
+    if len(fields) == 1:
+        return fields[0] == mtime
+    return fields == (mtime, st.st_size & 0xFFFFFFFF)
+
+
 def set_debconf(target, question, value, db=None):
     try:
         if 'UBIQUITY_OEM_USER_CONFIG' in os.environ and db:
@@ -118,11 +163,100 @@ def get_all_interfaces():
     return ifs
 
 
+# Flags for mount(2), from <sys/mount.h>.
+MS_BIND = 4096
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _mount = _libc.mount
+    _mount.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p,
+                       ctypes.c_ulong, ctypes.c_void_p)
+    _mount.restype = ctypes.c_int
+    _umount2 = _libc.umount2
+    _umount2.argtypes = (ctypes.c_char_p, ctypes.c_int)
+    _umount2.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _mount = None
+    _umount2 = None
+
+
+def mount(source, target, fstype=None, flags=0):
+    """Mount a filesystem, calling mount(2) directly if we can.
+
+    This saves forking mount(8) for the simple proc, sysfs and bind
+    mounts that we need around package operations.  As with
+    misc.execute, failures are logged and reported by returning False.
+    """
+    if _mount is None:
+        if flags & MS_BIND:
+            return misc.execute('mount', '--bind', source, target)
+        return misc.execute('mount', '-t', fstype, source, target)
+    if fstype is not None:
+        fstype = os.fsencode(fstype)
+    if _mount(os.fsencode(source), os.fsencode(target), fstype, flags,
+              None) != 0:
+        err = ctypes.get_errno()
+        syslog.syslog(syslog.LOG_ERR, 'mount %s on %s failed: %s' %
+                      (source, target, os.strerror(err)))
+        return False
+    return True
+
+
+def umount(target):
+    """Unmount a filesystem, calling umount2(2) directly if we can."""
+    if _umount2 is None:
+        return misc.execute('umount', target)
+    if _umount2(os.fsencode(target), 0) != 0:
+        err = ctypes.get_errno()
+        syslog.syslog(syslog.LOG_ERR, 'umount %s failed: %s' %
+                      (target, os.strerror(err)))
+        return False
+    return True
+
+
+# Targets that chroot_setup has prepared, mapped to [references, x11].
+_chroots = {}
+_chroots_lock = threading.Lock()
+
+
+def _chroot_setup_x11(target):
+    if 'SUDO_USER' in os.environ:
+        xauthority = os.path.expanduser('~%s/.Xauthority' %
+                                        os.environ['SUDO_USER'])
+    else:
+        xauthority = os.path.expanduser('~/.Xauthority')
+    if os.path.exists(xauthority):
+        shutil.copy(xauthority,
+                    os.path.join(target, 'root/.Xauthority'))
+
+    if not os.path.isdir(os.path.join(target, 'tmp/.X11-unix')):
+        os.mkdir(os.path.join(target, 'tmp/.X11-unix'))
+    mount('/tmp/.X11-unix', os.path.join(target, 'tmp/.X11-unix'),
+          flags=MS_BIND)
+
+
 def chroot_setup(target, x11=False):
-    """Set up /target for safe package management operations."""
+    """Set up /target for safe package management operations.
+
+    Calls may be nested: only the first one does any work, and everything
+    stays in place until the matching last call to chroot_cleanup.  Use
+    chroot() to hold the environment across several steps.
+    """
     if target == '/':
         return
 
+    with _chroots_lock:
+        state = _chroots.get(target)
+        if state is None:
+            _chroot_setup(target)
+            state = _chroots[target] = [0, False]
+        state[0] += 1
+        if x11 and not state[1] and 'DISPLAY' in os.environ:
+            _chroot_setup_x11(target)
+            state[1] = True
+
+
+def _chroot_setup(target):
     policy_rc_d = os.path.join(target, 'usr/sbin/policy-rc.d')
     with open(policy_rc_d, 'w') as f:
         print("""\
@@ -154,35 +288,39 @@ exit 0""", file=f)
         os.chmod(initctl, 0o755)
 
     if not os.path.exists(os.path.join(target, 'proc/cmdline')):
-        chrex(target, 'mount', '-t', 'proc', 'proc', '/proc')
+        mount('proc', os.path.join(target, 'proc'), 'proc')
     if not os.path.exists(os.path.join(target, 'sys/devices')):
-        chrex(target, 'mount', '-t', 'sysfs', 'sysfs', '/sys')
-    misc.execute('mount', '--bind', '/dev', os.path.join(target, 'dev'))
-    misc.execute('mount', '--bind', '/run', os.path.join(target, 'run'))
-
-    if x11 and 'DISPLAY' in os.environ:
-        if 'SUDO_USER' in os.environ:
-            xauthority = os.path.expanduser('~%s/.Xauthority' %
-                                            os.environ['SUDO_USER'])
-        else:
-            xauthority = os.path.expanduser('~/.Xauthority')
-        if os.path.exists(xauthority):
-            shutil.copy(xauthority,
-                        os.path.join(target, 'root/.Xauthority'))
-
-        if not os.path.isdir(os.path.join(target, 'tmp/.X11-unix')):
-            os.mkdir(os.path.join(target, 'tmp/.X11-unix'))
-        misc.execute('mount', '--bind', '/tmp/.X11-unix',
-                     os.path.join(target, 'tmp/.X11-unix'))
+        mount('sysfs', os.path.join(target, 'sys'), 'sysfs')
+    mount('/dev', os.path.join(target, 'dev'), flags=MS_BIND)
+    mount('/run', os.path.join(target, 'run'), flags=MS_BIND)
 
 
 def chroot_cleanup(target, x11=False):
-    """Undo the work done by chroot_setup."""
+    """Undo the work done by chroot_setup.
+
+    Nothing is torn down until the last outstanding chroot_setup call for
+    target has been matched, at which point any X11 setup goes too; the
+    x11 argument is accepted for symmetry with chroot_setup.
+    """
     if target == '/':
         return
 
-    if x11 and 'DISPLAY' in os.environ:
-        misc.execute('umount', os.path.join(target, 'tmp/.X11-unix'))
+    with _chroots_lock:
+        state = _chroots.get(target)
+        if state is None:
+            syslog.syslog(syslog.LOG_WARNING,
+                          'chroot_cleanup(%s) without chroot_setup' % target)
+            return
+        state[0] -= 1
+        if state[0] > 0:
+            return
+        del _chroots[target]
+        _chroot_cleanup(target, state[1])
+
+
+def _chroot_cleanup(target, x11):
+    if x11:
+        umount(os.path.join(target, 'tmp/.X11-unix'))
         try:
             os.rmdir(os.path.join(target, 'tmp/.X11-unix'))
         except OSError:
@@ -190,10 +328,10 @@ def chroot_cleanup(target, x11=False):
         osextras.unlink_force(os.path.join(target,
                                            'root/.Xauthority'))
 
-    chrex(target, 'umount', '/sys')
-    chrex(target, 'umount', '/proc')
-    misc.execute('umount', os.path.join(target, 'run'))
-    misc.execute('umount', os.path.join(target, 'dev'))
+    umount(os.path.join(target, 'sys'))
+    umount(os.path.join(target, 'proc'))
+    umount(os.path.join(target, 'run'))
+    umount(os.path.join(target, 'dev'))
 
     initctl = os.path.join(target, 'sbin/initctl')
     if os.path.exists('%s.REAL' % initctl):
@@ -209,6 +347,181 @@ def chroot_cleanup(target, x11=False):
     osextras.unlink_force(policy_rc_d)
 
 
+@contextlib.contextmanager
+def chroot(target, x11=False):
+    """Hold the chroot_setup environment for target for a with block."""
+    chroot_setup(target, x11=x11)
+    try:
+        yield
+    finally:
+        chroot_cleanup(target, x11=x11)
+
+
+class TriggerDeferral:
+    """Defer dpkg triggers and initramfs generation across several steps.
+
+    While active, every package operation in the target runs with dpkg
+    triggers disabled, and update-initramfs is diverted to a stub that
+    merely records what it was asked to do.  finish() then processes all
+    pending triggers in one go and regenerates each initramfs once.
+    """
+
+    apt_conf = 'etc/apt/apt.conf.d/00DeferTriggers'
+    requests = 'var/tmp/ubiquity-deferred-initramfs'
+    update_initramfs = '/usr/sbin/update-initramfs'
+
+    def __init__(self, target):
+        self.target = target
+        self.active = False
+
+    def target_file(self, *path):
+        return os.path.join(self.target, *path)
+
+    def start(self):
+        """Start deferring.  Return False if we could not do so."""
+        if self.active:
+            return True
+
+        osextras.unlink_force(self.target_file(self.requests))
+        if not chrex(self.target, 'dpkg-divert', '--package', 'ubiquity',
+                     '--rename', '--quiet', '--add', self.update_initramfs):
+            syslog.syslog(
+                syslog.LOG_WARNING,
+                'Could not divert %s; not deferring triggers' %
+                self.update_initramfs)
+            return False
+        # Never write over a real update-initramfs.
+        stub = self.target_file(self.update_initramfs.lstrip('/'))
+        try:
+            with open(stub, 'x') as f:
+                print("""\
+#!/bin/sh
+echo "$*" >>/%s
+exit 0""" % self.requests, file=f)
+        except FileExistsError:
+            syslog.syslog(
+                syslog.LOG_WARNING,
+                '%s still exists after diverting it; not deferring '
+                'triggers' % self.update_initramfs)
+            chrex(self.target, 'dpkg-divert', '--package', 'ubiquity',
+                  '--rename', '--quiet', '--remove', self.update_initramfs)
+            return False
+        os.chmod(stub, 0o755)
+
+        # Cover both our own apt_pkg commits and any apt-get run inside
+        # the target by plugins or hooks.
+        apt_pkg.config.set('DPkg::NoTriggers', 'true')
+        apt_pkg.config.set('DPkg::ConfigurePending', 'false')
+        with open(self.target_file(self.apt_conf), 'w') as apt_conf:
+            print('DPkg::NoTriggers "true";', file=apt_conf)
+            print('DPkg::ConfigurePending "false";', file=apt_conf)
+
+        self.active = True
+        return True
+
+    def _read_requests(self):
+        """Return the set of (mode, version) update-initramfs requests."""
+        requests = set()
+        try:
+            with open(self.target_file(self.requests)) as f:
+                lines = f.readlines()
+        except IOError:
+            return requests
+        for line in lines:
+            args = line.split()
+            mode = None
+            version = None
+            for i, arg in enumerate(args):
+                if arg in ('-c', '-u', '-d'):
+                    mode = arg
+                elif arg == '-k' and i + 1 < len(args):
+                    version = args[i + 1]
+            if mode is not None:
+                requests.add((mode, version))
+        return requests
+
+    def initramfs(self, *args):
+        """Run the real update-initramfs now, without ending deferral.
+
+        Requests recorded so far for the same kernel version are
+        satisfied by this run and are forgotten.
+        """
+        if not self.active:
+            return chrex(self.target, 'update-initramfs', *args)
+        ret = chrex(self.target, '%s.distrib' % self.update_initramfs,
+                    *args)
+        if ret and '-k' in args[:-1]:
+            version = args[args.index('-k') + 1]
+            requests = self.target_file(self.requests)
+            remaining = [(mode, other)
+                         for mode, other in self._read_requests()
+                         if other != version]
+            with open(requests, 'w') as f:
+                for mode, other in sorted(remaining, key=str):
+                    if other is None:
+                        print(mode, file=f)
+                    else:
+                        print(mode, '-k', other, file=f)
+        return ret
+
+    def finish(self):
+        """Process everything that was deferred since start().
+
+        Return True if this created an initramfs for a kernel that did not
+        have one, in which case the boot loader configuration may need to
+        be regenerated.
+        """
+        if not self.active:
+            return False
+        self.active = False
+
+        apt_pkg.config.clear('DPkg::NoTriggers')
+        apt_pkg.config.clear('DPkg::ConfigurePending')
+        osextras.unlink_force(self.target_file(self.apt_conf))
+
+        chroot_setup(self.target)
+        try:
+            try:
+                # Triggers may themselves ask for a new initramfs, so run
+                # them while the recording stub is still in place.
+                if not chrex(self.target, 'dpkg', '--triggers-only',
+                             '--pending'):
+                    syslog.syslog(
+                        syslog.LOG_WARNING,
+                        'Processing deferred dpkg triggers failed')
+                requests = self._read_requests()
+            finally:
+                osextras.unlink_force(
+                    self.target_file(self.update_initramfs.lstrip('/')))
+                chrex(self.target, 'dpkg-divert', '--package', 'ubiquity',
+                      '--rename', '--quiet', '--remove',
+                      self.update_initramfs)
+                osextras.unlink_force(self.target_file(self.requests))
+
+            # Deletions and brand new kernels first; one update of every
+            # initramfs then covers whatever else was asked for.
+            done = set()
+            created = False
+            for mode, version in sorted(requests, key=str):
+                if version is None:
+                    continue
+                initrd = self.target_file('boot', 'initrd.img-%s' % version)
+                if mode == '-d':
+                    chrex(self.target, 'update-initramfs', '-d',
+                          '-k', version)
+                    done.add(version)
+                elif mode == '-c' and not os.path.exists(initrd):
+                    chrex(self.target, 'update-initramfs', '-c',
+                          '-k', version)
+                    done.add(version)
+                    created = True
+            if any(version not in done for _, version in requests):
+                chrex(self.target, 'update-initramfs', '-u', '-k', 'all')
+            return created
+        finally:
+            chroot_cleanup(self.target)
+
+
 def record_installed(pkgs):
     """Record which packages we've explicitly installed so that we don't
     try to remove them later."""
@@ -272,6 +585,9 @@ class DebconfAcquireProgress(AcquireProgress):
         self.info = info
         self.old_capb = None
         self.eta = 0.0
+        # Called with each item once it has been downloaded to its final
+        # location.
+        self.on_done = None
 
     def start(self):
         if os.environ['UBIQUITY_FRONTEND'] != 'debconf_ui':
@@ -307,6 +623,14 @@ class DebconfAcquireProgress(AcquireProgress):
                 return False
         return True
 
+    def done(self, item):
+        AcquireProgress.done(self, item)
+        # apt normally has the file in place by now, but if not then
+        # whoever set on_done has to pick it up some other way.
+        if (self.on_done is not None and
+                os.path.exists(item.owner.destfile)):
+            self.on_done(item)
+
     def stop(self):
         if self.old_capb is not None:
             self.db.capb(self.old_capb)
@@ -504,6 +828,69 @@ def is_secure_boot():
         return False
 
 
+# Open apt caches, keyed by apt's root directory, along with the state of
+# the files they were opened from.
+_shared_caches = {}
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+        return st.st_ino, st.st_size, st.st_mtime_ns
+    except OSError:
+        return None
+
+
+def _cache_stamp():
+    status = apt_pkg.config.find_file('Dir::State::status')
+    stamp = [_file_stamp(path) for path in (
+        status,
+        # dpkg's list of foreign architectures.
+        os.path.join(os.path.dirname(status), 'arch'),
+        apt_pkg.config.find_dir('Dir::State::Lists'),
+        apt_pkg.config.find_file('Dir::Etc::sourcelist'),
+        apt_pkg.config.find_dir('Dir::Etc::sourceparts'),
+        apt_pkg.config.find_file('Dir::Etc::main'))]
+    # Files in apt.conf.d are usually edited in place, which doesn't change
+    # the directory, so look at each of them.
+    parts = apt_pkg.config.find_dir('Dir::Etc::parts')
+    try:
+        names = sorted(os.listdir(parts))
+    except OSError:
+        names = []
+    stamp.extend((name, _file_stamp(os.path.join(parts, name)))
+                 for name in names)
+    # Architectures may also have been configured in this process.
+    stamp.append(tuple(apt_pkg.config.value_list('APT::Architectures')))
+    stamp.append(apt_pkg.config.find('APT::Architecture'))
+    return tuple(stamp)
+
+
+def shared_cache():
+    """Return an open apt cache, shared with other installation steps.
+
+    Opening a cache is slow, so we keep one for each apt root directory and
+    only open it again if the dpkg status file, dpkg's foreign
+    architectures, the package lists, sources.list, or apt's configuration
+    files or architectures have changed since it was last opened.
+    Otherwise, any changes left marked by its previous user are cleared.
+    Callers must not close the cache.
+    """
+    root = apt_pkg.config.find_dir('Dir')
+    stamp = _cache_stamp()
+    if root in _shared_caches:
+        cache, old_stamp = _shared_caches[root]
+        if stamp != old_stamp:
+            syslog.syslog('Reopening apt cache for %s' % root)
+            cache.open(None)
+        else:
+            cache.clear()
+    else:
+        cache = Cache()
+    _shared_caches[root] = (cache, stamp)
+    return cache
+
+
 # TODO this can probably go away now.
 def get_cache_pkg(cache, pkg):
     # work around broken has_key in python-apt 0.6.16
@@ -581,48 +968,10 @@ def expand_dependencies_simple(cache, keep, to_remove, recommends=True):
     figure it out), but it allows us to ask apt fewer separate questions,
     and so is faster.
     """
-    keys = ['Pre-Depends', 'Depends']
-    if recommends:
-        keys.append('Recommends')
-
-    to_scan = set(keep)
-    to_scan_next = set()
-    expanded = set(keep)
-    while to_scan:
-        for pkg in to_scan:
-            cachedpkg = get_cache_pkg(cache, pkg)
-            if cachedpkg is None:
-                continue
-            ver = cachedpkg._pkg.current_ver
-            if ver is None:
-                continue
-            for key in keys:
-                if key in ver.depends_list:
-                    for dep_or in ver.depends_list[key]:
-                        # Keep the first element of a disjunction that's
-                        # installed; this mirrors what 'apt-get install' would
-                        # do if you were installing the package from scratch.
-                        # This doesn't handle versioned dependencies, but
-                        # that's largely OK since apt will spot those later;
-                        # the only case I can think of where this might have
-                        # trouble is "Recommends: foo (>= 2) | bar".
-                        for dep in dep_or:
-                            depname = dep.target_pkg.name
-                            cacheddep = get_cache_pkg(cache, depname)
-                            if cacheddep is None:
-                                continue
-                            if cacheddep._pkg.current_ver is not None:
-                                break
-                        else:
-                            continue
-                        if depname in expanded or depname not in to_remove:
-                            continue
-                        expanded.add(depname)
-                        to_scan_next.add(depname)
-        to_scan = to_scan_next
-        to_scan_next = set()
-
-    return expanded
+    graph = dependency_graph(cache)
+    needed = graph.needed(
+        graph.lookup(keep), graph.lookup(to_remove), recommends=recommends)
+    return set(keep) | {graph.names[pkg] for pkg in needed}
 
 
 def locale_to_language_pack(locale):
@@ -636,69 +985,341 @@ def locale_to_language_pack(locale):
         return lang
 
 
+class DependencyGraph:
+    """A snapshot of the dependencies between installed packages.
+
+    Asking python-apt about dependencies is slow, so we do it once for each
+    opened cache and keep what we need as arrays of integer package ids.
+    Each installed package has an id, which indexes packages and names.
+    Each Pre-Depends or Depends field of an installed package (an
+    or-group, or "clause") has an id too; clause_owner and clause_size give
+    the package it belongs to and how many installed packages satisfy it,
+    and rdep_clauses[rdep_start[pkg]:rdep_start[pkg + 1]] lists the
+    clauses that pkg helps to satisfy.  Going the other way,
+    dep_targets[dep_start[pkg]:dep_start[pkg + 1]] lists the first
+    installed alternative of each of pkg's Pre-Depends and Depends, and
+    rec_start and rec_targets do the same for its Recommends.
+    """
+
+    def __init__(self, cache):
+        self.source = cache._cache
+        self.packages = [pkg for pkg in cache._cache.packages
+                         if pkg.current_ver is not None]
+        self.names = [pkg.get_fullname(True) for pkg in self.packages]
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        by_apt_id = {pkg.id: i for i, pkg in enumerate(self.packages)}
+
+        self.clause_owner = array.array('I')
+        self.clause_size = array.array('I')
+        rdeps = [[] for _ in self.packages]
+        self.dep_start = array.array('I', [0])
+        self.dep_targets = array.array('I')
+        self.rec_start = array.array('I', [0])
+        self.rec_targets = array.array('I')
+        for i, pkg in enumerate(self.packages):
+            depends_list = pkg.current_ver.depends_list
+            for key, targets in (('PreDepends', self.dep_targets),
+                                 ('Depends', self.dep_targets),
+                                 ('Recommends', self.rec_targets)):
+                for dep_or in depends_list.get(key, ()):
+                    # Follow the first alternative that's installed; this
+                    # mirrors what 'apt-get install' would do if you were
+                    # installing the package from scratch.  This doesn't
+                    # handle versioned dependencies, but that's largely OK
+                    # since apt will spot those later; the only case I can
+                    # think of where this might have trouble is
+                    # "Recommends: foo (>= 2) | bar".
+                    for dep in dep_or:
+                        target = dep.target_pkg
+                        if target.current_ver is not None:
+                            targets.append(by_apt_id[target.id])
+                            break
+                    if key == 'Recommends':
+                        continue
+
+                    satisfiers = set()
+                    for dep in dep_or:
+                        for ver in dep.all_targets():
+                            parent = ver.parent_pkg
+                            current = parent.current_ver
+                            if current is not None and current.id == ver.id:
+                                satisfiers.add(by_apt_id[parent.id])
+                    if not satisfiers:
+                        # Already broken; nothing we remove can make it
+                        # any worse.
+                        continue
+                    clause = len(self.clause_owner)
+                    self.clause_owner.append(i)
+                    self.clause_size.append(len(satisfiers))
+                    for satisfier in satisfiers:
+                        rdeps[satisfier].append(clause)
+            self.dep_start.append(len(self.dep_targets))
+            self.rec_start.append(len(self.rec_targets))
+
+        self.rdep_start = array.array('I', [0])
+        self.rdep_clauses = array.array('I')
+        for clauses in rdeps:
+            self.rdep_clauses.extend(clauses)
+            self.rdep_start.append(len(self.rdep_clauses))
+
+    def lookup(self, names):
+        """Return the ids of those of names that are installed."""
+        return {self.ids[name] for name in names if name in self.ids}
+
+    def removal(self):
+        """Start working out the consequences of removing packages."""
+        return DependencyRemoval(self)
+
+    def needed(self, keep, candidates, recommends=True):
+        """Return the ids of the candidates that keep needs.
+
+        Starting from the packages with ids in keep, follow dependencies
+        (and Recommends, if recommends is set) as long as they lead to
+        packages with ids in candidates.
+        """
+        edges = [(self.dep_start, self.dep_targets)]
+        if recommends:
+            edges.append((self.rec_start, self.rec_targets))
+        is_candidate = bytearray(len(self.packages))
+        for pkg in candidates:
+            is_candidate[pkg] = 1
+        seen = bytearray(len(self.packages))
+        for pkg in keep:
+            seen[pkg] = 1
+        todo = list(keep)
+        needed = set()
+        while todo:
+            pkg = todo.pop()
+            for start, targets in edges:
+                for dep in targets[start[pkg]:start[pkg + 1]]:
+                    if is_candidate[dep] and not seen[dep]:
+                        seen[dep] = 1
+                        needed.add(dep)
+                        todo.append(dep)
+        return needed
+
+
+class DependencyRemoval:
+    """Packages removed so far from a DependencyGraph."""
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.removed = bytearray(len(graph.packages))
+        # How many installed packages still satisfy each clause.
+        self.remaining = array.array('I', graph.clause_size)
+
+    def closure(self, start):
+        """Return the ids of the packages that removing start would remove.
+
+        That is, start (less anything already removed) along with
+        everything that would then be left with an unsatisfiable
+        dependency, recursively.  Nothing is actually removed.
+        """
+        graph = self.graph
+        removed = self.removed
+        remaining = self.remaining
+        lost = {}
+        todo = [pkg for pkg in start if not removed[pkg]]
+        result = set(todo)
+        while todo:
+            pkg = todo.pop()
+            for clause in graph.rdep_clauses[
+                    graph.rdep_start[pkg]:graph.rdep_start[pkg + 1]]:
+                owner = graph.clause_owner[clause]
+                if removed[owner] or owner in result:
+                    continue
+                lost[clause] = lost.get(clause, 0) + 1
+                if lost[clause] == remaining[clause]:
+                    result.add(owner)
+                    todo.append(owner)
+        return result
+
+    def remove(self, pkgs):
+        """Remove the packages with ids in pkgs."""
+        graph = self.graph
+        for pkg in pkgs:
+            if self.removed[pkg]:
+                continue
+            self.removed[pkg] = 1
+            for clause in graph.rdep_clauses[
+                    graph.rdep_start[pkg]:graph.rdep_start[pkg + 1]]:
+                self.remaining[clause] -= 1
+
+
+# The graph for the most recently opened cache.
+_dependency_graph = None
+
+
+def dependency_graph(cache):
+    """Return a DependencyGraph for cache.
+
+    The graph is kept until the cache is opened again, which happens
+    whenever the set of installed packages may have changed.
+    """
+    global _dependency_graph
+    if (_dependency_graph is None or
+            _dependency_graph.source is not cache._cache):
+        _dependency_graph = DependencyGraph(cache)
+    return _dependency_graph
+
+
 def get_remove_list(cache, to_remove, recursive=False):
-    to_remove = set(to_remove)
+    """Mark as many of the packages in to_remove for removal as we can.
+
+    Removing a package breaks anything that depends on it.  If recursive is
+    set, then those packages are removed too; otherwise, a package is only
+    removed if everything that it breaks is in to_remove as well.  Return
+    the set of names of the packages marked for removal.
+
+    Rather than marking each package in turn and scanning the whole cache
+    to see what broke, we work this out from a DependencyGraph and then
+    mark everything at once.
+    """
+    graph = dependency_graph(cache)
+    removal = graph.removal()
+    removal.remove(
+        i for i, pkg in enumerate(graph.packages)
+        if cache._depcache.marked_delete(pkg))
+
+    to_remove = graph.lookup(to_remove)
     all_removed = set()
     while True:
         removed = set()
-        for pkg in to_remove:
-            cachedpkg = get_cache_pkg(cache, pkg)
-            if cachedpkg is not None and cachedpkg.is_installed:
-                apt_error = False
-                try:
-                    cachedpkg.mark_delete(auto_fix=False, purge=True)
-                except SystemError:
-                    apt_error = True
-                if apt_error:
-                    cachedpkg.mark_keep()
-                elif cache._depcache.broken_count > 0:
-                    # If we're recursively removing packages, or if all
-                    # of the broken packages are in the set of packages
-                    # to remove anyway, then go ahead and try to remove
-                    # them too.
-                    brokenpkgs = broken_packages(cache)
-                    broken_removed = set()
-                    while brokenpkgs and (recursive or
-                                          brokenpkgs <= to_remove):
-                        broken_removed_inner = set()
-                        for pkg2 in brokenpkgs:
-                            cachedpkg2 = get_cache_pkg(cache, pkg2)
-                            if cachedpkg2 is not None:
-                                broken_removed_inner.add(pkg2)
-                                try:
-                                    cachedpkg2.mark_delete(auto_fix=False,
-                                                           purge=True)
-                                except SystemError:
-                                    apt_error = True
-                                    break
-                        broken_removed |= broken_removed_inner
-                        if apt_error or not broken_removed_inner:
-                            break
-                        brokenpkgs = broken_packages(cache)
-                    if apt_error or cache._depcache.broken_count > 0:
-                        # That didn't work. Revert all the removals we
-                        # just tried.
-                        for pkg2 in broken_removed:
-                            get_cache_pkg(cache, pkg2).mark_keep()
-                        cachedpkg.mark_keep()
-                    else:
-                        removed.add(pkg)
-                        removed |= broken_removed
-                else:
-                    removed.add(pkg)
-                if cache._depcache.broken_count > 0:
-                    # We have a conflict we couldn't solve
-                    cache.clear()
-                    raise InstallStepError(
-                        "Unable to remove packages due to conflicts.")
-
+        for pkg in sorted(to_remove):
+            would_remove = removal.closure([pkg])
+            if recursive or would_remove <= to_remove:
+                removal.remove(would_remove)
+                removed.add(pkg)
+                removed |= would_remove
         if not removed:
             break
         to_remove -= removed
         all_removed |= removed
+
+    all_removed = {graph.names[pkg] for pkg in all_removed}
+    for pkg in sorted(all_removed):
+        try:
+            cache[pkg].mark_delete(auto_fix=False, purge=True)
+        except SystemError:
+            cache[pkg].mark_keep()
+            all_removed.discard(pkg)
+    if cache._depcache.broken_count > 0:
+        # We have a conflict we couldn't solve
+        cache.clear()
+        raise InstallStepError(
+            "Unable to remove packages due to conflicts.")
     return all_removed
 
 
+def _apt_quote(value, bad):
+    """Quote value in the same way as apt's QuoteString."""
+    return ''.join(
+        '%%%02x' % byte
+        if chr(byte) in bad or byte == 0x25 or not 0x20 < byte < 0x7F
+        else chr(byte)
+        for byte in value.encode('UTF-8'))
+
+
+def archive_hashes(cache):
+    """Map the archives that committing cache will fetch to their SHA256.
+
+    apt names a downloaded archive after its package's name, version and
+    architecture (see pkgAcqArchive), so we can work out every name up
+    front rather than mapping each file back to a package afterwards.
+    Keys are file names without the extension.
+    """
+    hashes = {}
+    for pkg in cache.get_changes():
+        if pkg.marked_delete:
+            continue
+        version = pkg.candidate
+        if version is None:
+            continue
+        hashes['%s_%s_%s' % (
+            _apt_quote(pkg.shortname, '_:'),
+            _apt_quote(version.version, '_:'),
+            _apt_quote(version.architecture, '_:.'))] = version.sha256
+    return hashes
+
+
+def verify_archive(path, size, sha256=None):
+    """Check a downloaded archive, removing it and raising IOError if bad."""
+    with open(path, 'rb') as archive:
+        st = os.fstat(archive.fileno())
+        if st.st_size != size:
+            osextras.unlink_force(path)
+            raise IOError("%s size mismatch: %ld != %ld" %
+                          (path, st.st_size, size))
+        if sha256 is None:
+            return
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: archive.read(1024 * 1024), b''):
+            digest.update(chunk)
+        if digest.hexdigest() != sha256:
+            osextras.unlink_force(path)
+            raise IOError("%s SHA256 checksum mismatch: %s != %s" %
+                          (path, digest.hexdigest(), sha256))
+
+
+def _read_dpkg_list(path):
+    """Return the paths in a dpkg .list file, relative to the root."""
+    with open(path, 'rb') as dpkg_list:
+        return [os.fsdecode(line.rstrip(b'\n').lstrip(b'/'))
+                for line in dpkg_list if line.startswith(b'/')]
+
+
+def files_to_skip(packages, admindir='/var/lib/dpkg'):
+    """Work out which files need not be copied for a set of packages.
+
+    Return a tuple (files, dirs).  files is a frozenset of the paths,
+    relative to the root, of everything installed by the given packages.
+    dirs is a frozenset of the directories in that set that no other
+    installed package has anything in.  Nothing under these needs to be
+    copied at all, so copy_all doesn't even need to look inside them.
+
+    This reads dpkg's .list files directly rather than running dpkg -L,
+    falling back to dpkg -L for any package whose .list file we can't
+    find.
+    """
+    packages = frozenset(packages)
+    info = os.path.join(admindir, 'info')
+    files = set()
+    found = set()
+    other_lists = []
+    for name in os.listdir(info):
+        if not name.endswith('.list'):
+            continue
+        # Multi-arch: some packages have their architecture in the name,
+        # and may be installed for more than one architecture.
+        pkg = name[:-len('.list')].split(':')[0]
+        if pkg in packages:
+            files.update(_read_dpkg_list(os.path.join(info, name)))
+            found.add(pkg)
+        else:
+            other_lists.append(os.path.join(info, name))
+
+    missing = packages - found
+    if missing:
+        cmd = ['dpkg', '-L']
+        cmd.extend(sorted(missing))
+        subp = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        for line in subp.communicate()[0].splitlines():
+            if line.startswith('/'):
+                files.add(line.lstrip('/'))
+    files.discard('.')
+    files.discard('')
+
+    # dpkg lists every directory leading to each file a package installs,
+    # so if any other package has anything in one of our directories, then
+    # that directory will be in its list too.
+    dirs = {os.path.dirname(path) for path in files} & files
+    for other_list in other_lists:
+        dirs.difference_update(_read_dpkg_list(other_list))
+    return frozenset(files), frozenset(dirs)
+
+
 def remove_target(source_root, target_root, relpath, st_source):
     """Remove a target file if necessary and if we can.
 
@@ -772,48 +1393,844 @@ def remove_target(source_root, target_root, relpath, st_source):
             backuppath = backuppath + '.bak'
 
 
-def copy_file(db, sourcepath, targetpath, md5_check):
-    while 1:
-        if md5_check:
-            sourcehash = hashlib.md5()
+# An entry to be copied from the live filesystem.  st is an os.stat_result
+# or a ManifestStat.  linkto, xattrs and digest are None unless we already
+# know them from a copy manifest, in which case we don't need to look at the
+# source to find them out.
+CopyEntry = namedtuple('CopyEntry', 'relpath, st, linkto, xattrs, digest')
+
+# The subset of os.stat_result that copy_all uses, as recorded in a copy
+# manifest.
+ManifestStat = namedtuple(
+    'ManifestStat',
+    'st_mode, st_uid, st_gid, st_size, st_atime, st_mtime, st_rdev')
+
+COPY_MANIFEST_MAGIC = b'UBQCOPY2'
+# The header records the identity of the squashfs that the manifest
+# describes (see squashfs_identity), followed by the total size and number
+# of entries.
+_copy_manifest_header = struct.Struct('<8sQIQQQ')
+_copy_manifest_record = struct.Struct('<HIIIQqQHBH')
+_copy_manifest_xattr = struct.Struct('<BI')
+
+
+def walk_source(source, prune=frozenset()):
+    """Walk the tree under source, yielding a CopyEntry for everything in it.
+
+    Every directory is yielded before anything inside it.  Directories
+    whose relative paths are in prune are skipped entirely, along with
+    everything inside them.  This uses os.scandir() and keeps each lstat()
+    result it needs, so that we only stat each path once.
+    """
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        subdirs = []
+        with os.scandir(os.path.join(source, reldir)) as it:
+            for dirent in it:
+                relpath = os.path.join(reldir, dirent.name)
+                if dirent.is_dir(follow_symlinks=False):
+                    if relpath in prune:
+                        continue
+                    subdirs.append(relpath)
+                yield CopyEntry(relpath, dirent.stat(follow_symlinks=False),
+                                None, None, None)
+        stack.extend(reversed(subdirs))
+
+
+# The parts of a squashfs superblock that we use, from
+# <linux/squashfs_fs.h>: magic, mkfs_time, bytes_used and
+# xattr_id_table_start.
+SQUASHFS_MAGIC = 0x73717368
+_squashfs_super_block = struct.Struct('<I4xI28xQ8xQ')
+
+
+def squashfs_identity(path):
+    """Return a tuple identifying the squashfs image at path.
+
+    This is the size of the image along with the creation time and used
+    size from its superblock, which between them change whenever the image
+    is rebuilt.  Return None if path is missing or is not a squashfs.
+    """
+    try:
+        with open(path, 'rb') as image:
+            size = os.fstat(image.fileno()).st_size
+            magic, mkfs_time, bytes_used, _ = _squashfs_super_block.unpack(
+                image.read(_squashfs_super_block.size))
+    except (OSError, struct.error):
+        return None
+    if magic != SQUASHFS_MAGIC:
+        return None
+    return size, mkfs_time, bytes_used
+
+
+def _check_copy_manifest(manifest, count):
+    """Check that count entries exactly fill the rest of manifest.
+
+    This skips over the variable-length parts of each entry, so is much
+    cheaper than reading them.  It lets us fall back to walking the source
+    before we start copying, rather than finding a truncated manifest
+    halfway through.
+    """
+    start = manifest.tell()
+    end = os.fstat(manifest.fileno()).st_size
+    try:
+        for _ in range(count):
+            (path_len, _, _, _, _, _, _, link_len, digest_len,
+             xattr_count) = _copy_manifest_record.unpack(
+                manifest.read(_copy_manifest_record.size))
+            skip = path_len + link_len + digest_len
+            for _ in range(xattr_count):
+                manifest.seek(skip, os.SEEK_CUR)
+                name_len, value_len = _copy_manifest_xattr.unpack(
+                    manifest.read(_copy_manifest_xattr.size))
+                skip = name_len + value_len
+            manifest.seek(skip, os.SEEK_CUR)
+            if manifest.tell() > end:
+                return False
+        return manifest.tell() == end
+    except struct.error:
+        return False
+    finally:
+        manifest.seek(start)
+
+
+def _read_copy_manifest_entries(manifest, count, prune):
+    # Entries are sorted by path, so everything inside a directory
+    # immediately follows it.
+    pruned = None
+    try:
+        for _ in range(count):
+            (path_len, mode, uid, gid, size, mtime_ns, rdev, link_len,
+             digest_len, xattr_count) = _copy_manifest_record.unpack(
+                manifest.read(_copy_manifest_record.size))
+            relpath = os.fsdecode(manifest.read(path_len))
+            linkto = os.fsdecode(manifest.read(link_len)) if link_len else None
+            digest = manifest.read(digest_len) if digest_len else None
+            xattrs = []
+            for _ in range(xattr_count):
+                name_len, value_len = _copy_manifest_xattr.unpack(
+                    manifest.read(_copy_manifest_xattr.size))
+                name = os.fsdecode(manifest.read(name_len))
+                xattrs.append((name, manifest.read(value_len)))
+            if pruned is not None and relpath.startswith(pruned):
+                continue
+            if stat.S_ISDIR(mode) and relpath in prune:
+                pruned = relpath + '/'
+                continue
+            mtime = mtime_ns / 1e9
+            st = ManifestStat(mode, uid, gid, size, mtime, mtime, rdev)
+            yield CopyEntry(relpath, st, linkto, xattrs, digest)
+    finally:
+        manifest.close()
+
+
+def read_copy_manifest(path, prune=frozenset(), squashfs=None):
+    """Read a copy manifest written by write_copy_manifest.
+
+    Return a tuple of the total size of everything in the manifest and an
+    iterator over its entries, or None if there is no usable manifest.
+    Directories whose relative paths are in prune are skipped, along with
+    everything inside them.  If squashfs is given, the manifest is only
+    used if it was written for that squashfs image; a remastered image
+    often comes with a stale manifest.
+    """
+    try:
+        manifest = open(path, 'rb', buffering=1024 * 1024)
+    except FileNotFoundError:
+        return None
+    try:
+        (magic, squashfs_size, mkfs_time, bytes_used, total_size,
+         count) = _copy_manifest_header.unpack(
+            manifest.read(_copy_manifest_header.size))
+    except struct.error:
+        magic = None
+    if magic != COPY_MANIFEST_MAGIC:
+        syslog.syslog(syslog.LOG_WARNING,
+                      'Ignoring %s: not a copy manifest' % path)
+        manifest.close()
+        return None
+    if (squashfs is not None and
+            squashfs_identity(squashfs) !=
+            (squashfs_size, mkfs_time, bytes_used)):
+        syslog.syslog(syslog.LOG_WARNING,
+                      'Ignoring %s: it does not describe %s' %
+                      (path, squashfs))
+        manifest.close()
+        return None
+    if not _check_copy_manifest(manifest, count):
+        syslog.syslog(syslog.LOG_WARNING,
+                      'Ignoring %s: truncated or corrupt' % path)
+        manifest.close()
+        return None
+    return total_size, _read_copy_manifest_entries(manifest, count, prune)
+
+
+def write_copy_manifest(source, path, digest_size=16, squashfs=None):
+    """Write a copy manifest describing the tree under source to path.
+
+    This is intended to be run when building the live medium, and the
+    manifest shipped alongside the live filesystem, so that copy_all can
+    read one file sequentially rather than stat every path.  Entries are
+    sorted by path so that every directory precedes its contents.  squashfs
+    is the image that source was built into or is mounted from; the
+    manifest records its identity so that readers can tell if it is stale.
+    """
+    identity = None
+    if squashfs is not None:
+        identity = squashfs_identity(squashfs)
+        if identity is None:
+            raise ValueError('%s is not a squashfs image' % squashfs)
+    entries = sorted(walk_source(source),
+                     key=lambda entry: entry.relpath.split('/'))
+    with open(path, 'wb') as manifest:
+        manifest.write(_copy_manifest_header.pack(
+            COPY_MANIFEST_MAGIC, *(identity or (0, 0, 0)),
+            sum(entry.st.st_size for entry in entries), len(entries)))
+        for entry in entries:
+            sourcepath = os.path.join(source, entry.relpath)
+            st = entry.st
+            linkto = b''
+            digest = b''
+            if stat.S_ISLNK(st.st_mode):
+                linkto = os.fsencode(os.readlink(sourcepath))
+            elif stat.S_ISREG(st.st_mode) and digest_size:
+                filehash = hashlib.blake2b(digest_size=digest_size)
+                with open(sourcepath, 'rb') as sourcefh:
+                    _read_hash(sourcefh, filehash,
+                               copy_buffer_size(st.st_size))
+                digest = filehash.digest()
+            try:
+                xattrs = [
+                    (os.fsencode(name),
+                     os.getxattr(sourcepath, name, follow_symlinks=False))
+                    for name in os.listxattr(
+                        sourcepath, follow_symlinks=False)]
+            except OSError as e:
+                if e.errno not in (errno.EPERM, errno.ENOTSUP,
+                                   errno.ENODATA):
+                    raise
+                xattrs = []
+            relpath = os.fsencode(entry.relpath)
+            manifest.write(_copy_manifest_record.pack(
+                len(relpath), st.st_mode, st.st_uid, st.st_gid, st.st_size,
+                st.st_mtime_ns, st.st_rdev, len(linkto), len(digest),
+                len(xattrs)))
+            manifest.write(relpath)
+            manifest.write(linkto)
+            manifest.write(digest)
+            for name, value in xattrs:
+                manifest.write(_copy_manifest_xattr.pack(
+                    len(name), len(value)))
+                manifest.write(name)
+                manifest.write(value)
+
+
+# ioctl to map a file's extents, and the sizes of struct fiemap and struct
+# fiemap_extent, from <linux/fs.h> and <linux/fiemap.h>.
+FS_IOC_FIEMAP = 0xC020660B
+_fiemap = struct.Struct('=QQIIII')
+_fiemap_extent = struct.Struct('=QQQQQIIII')
+
+
+def physical_offset(path):
+    """Return the physical offset of the start of path on its device.
+
+    Return None if the file has no extents, or if its filesystem doesn't
+    support FIEMAP (squashfs, for one, doesn't).
+    """
+    request = bytearray(_fiemap.size + _fiemap_extent.size)
+    _fiemap.pack_into(request, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    if _fiemap.unpack_from(request, 0)[3] == 0:
+        return None
+    return _fiemap_extent.unpack_from(request, _fiemap.size)[1]
+
+
+def read_order_key(order):
+    """Return a function giving a sort key for reading a file.
+
+    The function takes the source path and its stat result.  For 'inode',
+    the key is the inode number, which on squashfs follows the order in
+    which mksquashfs laid out the data.  For 'extent', it is the physical
+    offset of the file's first extent, for filesystems that support FIEMAP,
+    falling back to the inode number.  Anything else (including 'walk')
+    returns None, meaning that files should be read in the order in which
+    we find them.  Entries from a copy manifest carry no inode number, so
+    they stay in manifest order.
+    """
+    if order == 'inode':
+        return lambda sourcepath, st: getattr(st, 'st_ino', 0)
+    elif order == 'extent':
+        def key(sourcepath, st):
+            offset = physical_offset(sourcepath)
+            if offset is None:
+                return (1, getattr(st, 'st_ino', 0))
+            return (0, offset)
+        return key
+    else:
+        return None
+
+
+# ioctl to make the target share the source's extents (a "reflink"), from
+# <linux/fs.h>.
+FICLONE = 0x40049409
+
+# Errors from a kernel-side copy method that mean it can't be used between
+# this pair of devices at all.  We fall back to the next method, and don't
+# try this one again for the same devices.
+_copy_unsupported_errnos = (
+    errno.ENOSYS, errno.EXDEV, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOTTY)
+
+# Errors that only mean the method can't copy this particular file.  We fall
+# back to the next method for this file, but try it again for the next.
+_copy_fallback_errnos = _copy_unsupported_errnos + (errno.EINVAL,)
+
+# Kernel-side copy methods that are unsupported for a given pair of source
+# and target devices, so that we don't retry them for every file.
+_copy_methods_failed = set()
+
+
+def _copy_reflink(sourcefd, targetfd, size):
+    fcntl.ioctl(targetfd, FICLONE, sourcefd)
+    return True
+
+
+def _copy_fd_loop(copy, sourcefd, targetfd, size):
+    copied = 0
+    while copied < size:
+        count = copy(sourcefd, targetfd, min(size - copied, 1 << 30))
+        if count == 0:
+            # Some filesystems misreport file sizes or don't implement these
+            # system calls properly; if nothing was copied at all then let a
+            # simpler method deal with it.
+            return copied != 0
+        copied += count
+    return True
+
+
+def _copy_file_range(sourcefd, targetfd, size):
+    return _copy_fd_loop(os.copy_file_range, sourcefd, targetfd, size)
+
+
+def _copy_sendfile(sourcefd, targetfd, size):
+    return _copy_fd_loop(
+        lambda infd, outfd, count: os.sendfile(outfd, infd, None, count),
+        sourcefd, targetfd, size)
+
+
+def _copy_kernel(sourcefh, targetfh):
+    """Try to copy sourcefh to targetfh without the data passing through
+    user space.  Return True on success, or False if the caller should fall
+    back to copying the data itself."""
+    sourcest = os.fstat(sourcefh.fileno())
+    targetst = os.fstat(targetfh.fileno())
+    if sourcest.st_size == 0:
+        return True
+    methods = []
+    if sourcest.st_dev == targetst.st_dev:
+        methods.append(_copy_reflink)
+    if hasattr(os, 'copy_file_range'):
+        methods.append(_copy_file_range)
+    if hasattr(os, 'sendfile'):
+        methods.append(_copy_sendfile)
+    for method in methods:
+        key = (method.__name__, sourcest.st_dev, targetst.st_dev)
+        if key in _copy_methods_failed:
+            continue
+        try:
+            if method(sourcefh.fileno(), targetfh.fileno(),
+                      sourcest.st_size):
+                return True
+        except OSError as e:
+            if e.errno not in _copy_fallback_errnos:
+                raise
+            if e.errno in _copy_unsupported_errnos:
+                _copy_methods_failed.add(key)
+        # Start again from scratch with the next method, in case this one
+        # got part of the way through.
+        sourcefh.seek(0)
+        targetfh.seek(0)
+        targetfh.truncate()
+    return False
+
+
+def copy_buffer_size(size):
+    """Pick a buffer size for copying a file of the given size.
+
+    Small files are read in a single call, and large ones in chunks that are
+    large enough to keep the number of system calls down without using a
+    silly amount of memory per copying thread.
+    """
+    return min(max(size, 16 * 1024), 1024 * 1024)
+
+
+# Flags for sync_file_range(), from <fcntl.h>.
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+try:
+    _sync_file_range = ctypes.CDLL(None, use_errno=True).sync_file_range
+    _sync_file_range.argtypes = (
+        ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint)
+    _sync_file_range.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _sync_file_range = None
+
+
+def sync_file_range(fd, offset, nbytes, flags):
+    """Call sync_file_range(2), which Python doesn't wrap for us.
+
+    If it isn't available, then we can't start writeback without waiting
+    for it, so we do nothing unless asked to wait, in which case we use
+    fdatasync() instead.
+    """
+    if _sync_file_range is not None:
+        if _sync_file_range(fd, offset, nbytes, flags) == 0:
+            return
+        err = ctypes.get_errno()
+        if err not in (errno.ENOSYS, errno.ESPIPE):
+            raise OSError(err, os.strerror(err))
+    if flags & SYNC_FILE_RANGE_WAIT_AFTER:
+        os.fdatasync(fd)
+
+
+class WritebackManager:
+    """Keep the amount of dirty data left behind by copying under control.
+
+    Left to itself, the kernel lets freshly-copied data pile up in the page
+    cache and then writes it out all at once, which makes for uneven I/O
+    and a long stall at the end, and can squeeze everything else out of
+    memory on machines without much of it.  Instead, we start writing back
+    each file as soon as it has been copied, and once more than limit bytes
+    (or max_files files) are outstanding we wait for the oldest ones to
+    reach the disk and drop them from the page cache.  This is safe to use
+    from several threads at once.
+    """
+
+    def __init__(self, limit=None, max_files=256):
+        if limit is None:
+            # An eighth of physical memory, but no more than we need to
+            # keep the disk busy.
+            try:
+                memory = (os.sysconf('SC_PHYS_PAGES') *
+                          os.sysconf('SC_PAGE_SIZE'))
+            except (ValueError, OSError):
+                memory = 0
+            limit = min(max(memory // 8, 16 * 1024 * 1024),
+                        256 * 1024 * 1024)
+        self.limit = limit
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._dirty = 0
+
+    def add(self, fd, size):
+        """Start writing back size bytes just written to the file on fd.
+
+        fd is duplicated, so the caller may close it as usual.
+        """
+        sync_file_range(fd, 0, 0, SYNC_FILE_RANGE_WRITE)
+        fd = os.dup(fd)
+        finish = []
+        with self._lock:
+            self._pending.append((fd, size))
+            self._dirty += size
+            while self._pending and (self._dirty > self.limit or
+                                     len(self._pending) > self.max_files):
+                oldfd, oldsize = self._pending.popleft()
+                self._dirty -= oldsize
+                finish.append(oldfd)
+        self._finish(finish)
+
+    def _finish(self, fds):
+        try:
+            for fd in fds:
+                sync_file_range(fd, 0, 0,
+                                SYNC_FILE_RANGE_WAIT_BEFORE |
+                                SYNC_FILE_RANGE_WRITE |
+                                SYNC_FILE_RANGE_WAIT_AFTER)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def drain(self):
+        """Wait for all outstanding writeback to finish."""
+        with self._lock:
+            fds = [fd for fd, _ in self._pending]
+            self._pending.clear()
+            self._dirty = 0
+        self._finish(fds)
+
+
+def load_hash_manifest(path):
+    """Load a manifest of file checksums from the live medium.
 
-        with open(sourcepath, 'rb') as sourcefh:
-            with open(targetpath, 'wb') as targetfh:
+    The manifest is in the format written by b2sum (optionally with a
+    shorter digest length using -l), with paths relative to the root of the
+    live filesystem.  Return a dictionary mapping relative paths to binary
+    digests; an empty dictionary if there is no manifest.
+    """
+    hashes = {}
+    try:
+        with open(path, 'rb') as manifest:
+            for line in manifest:
+                try:
+                    digest, relpath = line.rstrip(b'\n').split(b' ', 1)
+                    digest = bytes.fromhex(digest.decode('ascii'))
+                except ValueError:
+                    continue
+                if not 0 < len(digest) <= hashlib.blake2b.MAX_DIGEST_SIZE:
+                    continue
+                # b2sum puts either a space or a '*' (binary mode) before
+                # the file name.
+                relpath = relpath[1:]
+                if relpath.startswith(b'./'):
+                    relpath = relpath[2:]
+                hashes[os.fsdecode(relpath.lstrip(b'/'))] = digest
+    except FileNotFoundError:
+        pass
+    return hashes
+
+
+def _read_hash(fileobj, filehash, bufsize):
+    while True:
+        buf = fileobj.read(bufsize)
+        if not buf:
+            break
+        filehash.update(buf)
+
+
+def _no_lap(phase):
+    pass
+
+
+def copy_file_data(sourcepath, targetpath, md5_check, expected=None,
+                   strict=False, st=None, xattrs=None, timer=None,
+                   writeback=None):
+    """Copy the contents of sourcepath to targetpath.
+
+    Return False if md5_check is set and the copy could not be verified,
+    otherwise True.  This never talks to debconf, so it is safe to call from
+    worker threads.
+
+    If we don't need to check the copy, then we try to have the kernel do
+    it for us, either by sharing extents with the source (if both are on
+    the same filesystem), or using copy_file_range() or sendfile().
+
+    Otherwise, we hash the data (using BLAKE2b, despite the name of
+    md5_check) as we copy it.  If expected is the digest of the source file
+    from the live medium's manifest, then comparing against that is enough
+    to verify the copy and we don't read the target again unless strict is
+    set.  In strict mode, the target is flushed and dropped from the page
+    cache before being read back, so that we check what actually reached
+    the disk rather than what is still in memory.
+
+    If st is given, then the target's metadata is copied from it (and from
+    xattrs, as for copy_metadata) while we still have the file open.
+
+    If writeback is a WritebackManager, then the target is handed to it
+    once written, and the source is dropped from the page cache since we
+    won't need it again.
+
+    If timer is given, its lap() method is called at the end of each phase
+    of the copy (see telemetry.CopyStats).
+    """
+    lap = timer.lap if timer is not None else _no_lap
+    if expected is not None:
+        digest_size = len(expected)
+    else:
+        digest_size = 32
+    with open(sourcepath, 'rb') as sourcefh:
+        lap('read')
+        with open(targetpath, 'wb') as targetfh:
+            lap('write')
+            bufsize = None
+            if not md5_check:
+                copied = _copy_kernel(sourcefh, targetfh)
+                lap('copy')
+            if md5_check or not copied:
+                bufsize = copy_buffer_size(
+                    os.fstat(sourcefh.fileno()).st_size)
+                if md5_check:
+                    sourcehash = hashlib.blake2b(digest_size=digest_size)
                 while True:
-                    buf = sourcefh.read(16 * 1024)
+                    buf = sourcefh.read(bufsize)
+                    lap('read')
                     if not buf:
                         break
                     targetfh.write(buf)
+                    lap('write')
                     if md5_check:
                         sourcehash.update(buf)
+                        lap('verify')
+                targetfh.flush()
+                lap('write')
+
+            if st is not None:
+                copy_metadata_fd(sourcefh.fileno(), targetfh.fileno(), st,
+                                 xattrs=xattrs)
+                lap('metadata')
+
+            if md5_check and strict:
+                os.fdatasync(targetfh.fileno())
+                os.posix_fadvise(
+                    targetfh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                lap('fsync')
+            elif writeback is not None:
+                writeback.add(targetfh.fileno(),
+                              os.fstat(targetfh.fileno()).st_size)
+                lap('fsync')
+
+        if writeback is not None:
+            os.posix_fadvise(sourcefh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    if not md5_check:
+        return True
+
+    if expected is not None:
+        if sourcehash.digest() != expected:
+            syslog.syslog(syslog.LOG_WARNING,
+                          '%s does not match the live medium manifest' %
+                          sourcepath)
+            return False
+        if not strict:
+            return True
+
+    with open(targetpath, 'rb') as targetfh:
+        targethash = hashlib.blake2b(digest_size=digest_size)
+        _read_hash(targetfh, targethash, bufsize)
+        if strict:
+            os.posix_fadvise(targetfh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    lap('verify')
 
-        if not md5_check:
+    return targethash.digest() == sourcehash.digest()
+
+
+def source_has_xattrs(source):
+    """Might anything in the tree under source have extended attributes?
+
+    If not, then there's no point asking about the xattrs of every file as
+    we copy it.  Squashfs records whether the image has an xattr table at
+    all, and other filesystems will tell us if they don't support xattrs.
+    If in doubt, assume that there may be some.
+    """
+    fsname, fstype, _ = misc.mount_info(source)
+    if fstype == 'squashfs':
+        try:
+            with open(fsname, 'rb') as device:
+                magic, _, _, xattr_table = _squashfs_super_block.unpack(
+                    device.read(_squashfs_super_block.size))
+            if magic == SQUASHFS_MAGIC:
+                return xattr_table != 0xFFFFFFFFFFFFFFFF
+        except (OSError, struct.error):
+            pass
+    try:
+        os.listxattr(source)
+    except OSError as e:
+        if e.errno == errno.ENOTSUP:
+            return False
+    return True
+
+
+def copy_metadata_fd(source, targetfd, st, xattrs=None):
+    """Copy metadata to an open file descriptor.
+
+    Ownership, permissions, timestamps and extended attributes are set on
+    targetfd directly, so that the kernel doesn't have to look up the path
+    again for each of them.  source may be a path or an open file
+    descriptor, and is only used to read extended attributes if xattrs is
+    None; pass an empty list if there are none to copy.
+    """
+    os.fchown(targetfd, st.st_uid, st.st_gid)
+    os.fchmod(targetfd, stat.S_IMODE(st.st_mode))
+    if not stat.S_ISDIR(st.st_mode):
+        try:
+            os.utime(targetfd, (st.st_atime, st.st_mtime))
+        except Exception:
+            # We can live with timestamps being wrong.
+            pass
+    try:
+        if xattrs is None:
+            xattrs = [(attrname, os.getxattr(source, attrname))
+                      for attrname in os.listxattr(source)]
+        for attrname, attrvalue in xattrs:
+            os.setxattr(targetfd, attrname, attrvalue)
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.ENODATA):
+            raise
+
+
+def copy_metadata(sourcepath, targetpath, st, xattrs=None):
+    """Copy ownership, permissions, timestamps and extended attributes.
+
+    st is the result of os.lstat(sourcepath), or the equivalent from a copy
+    manifest.  If xattrs is not None, it is a list of (name, value) pairs
+    to set rather than reading them from sourcepath.  Directory timestamps
+    are not applied here, since copying items into the directory would
+    change them again; the caller must do that once the directory has been
+    filled.
+
+    Regular files and directories are opened so that we can use
+    copy_metadata_fd.  Anything else might block or have side-effects if
+    opened, so we fall back to path-based calls.
+    """
+    if stat.S_ISREG(st.st_mode) or stat.S_ISDIR(st.st_mode):
+        flags = os.O_RDONLY | os.O_NOFOLLOW
+        if stat.S_ISDIR(st.st_mode):
+            flags |= os.O_DIRECTORY
+        targetfd = os.open(targetpath, flags)
+        try:
+            copy_metadata_fd(sourcepath, targetfd, st, xattrs=xattrs)
+        finally:
+            os.close(targetfd)
+        return
+
+    os.lchown(targetpath, st.st_uid, st.st_gid)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(targetpath, stat.S_IMODE(st.st_mode))
+    # os.utime() sets timestamp of target, not link
+    if not stat.S_ISLNK(st.st_mode):
+        try:
+            os.utime(targetpath, (st.st_atime, st.st_mtime))
+        except Exception:
+            # We can live with timestamps being wrong.
+            pass
+    if (hasattr(os, "listxattr") and
+            hasattr(os, "supports_follow_symlinks") and
+            os.supports_follow_symlinks):
+        try:
+            if xattrs is None:
+                xattrs = [
+                    (attrname, os.getxattr(
+                        sourcepath, attrname, follow_symlinks=False))
+                    for attrname in os.listxattr(
+                        sourcepath, follow_symlinks=False)]
+            for attrname, attrvalue in xattrs:
+                os.setxattr(
+                    targetpath, attrname, attrvalue, follow_symlinks=False)
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.ENODATA):
+                raise
+
+
+def ask_copy_error(db, targetpath):
+    """Ask the user what to do about a checksum failure on targetpath.
+
+    Return 'retry' or 'skip'.  If the user chose to abort, exit.
+    """
+    error_template = 'ubiquity/install/copying_error/md5'
+    db.subst(error_template, 'FILE', targetpath)
+    db.input('critical', error_template)
+    db.go()
+    response = db.get(error_template)
+    if response == 'abort':
+        syslog.syslog(syslog.LOG_ERR,
+                      'Checksum failure on %s' % targetpath)
+        sys.exit(3)
+    return response
+
+
+def copy_file(db, sourcepath, targetpath, md5_check, expected=None,
+              strict=False, st=None, xattrs=None):
+    while not copy_file_data(sourcepath, targetpath, md5_check,
+                             expected=expected, strict=strict, st=st,
+                             xattrs=xattrs):
+        if ask_copy_error(db, targetpath) == 'skip':
             break
 
-        with open(targetpath, 'rb') as targetfh:
-            if md5_check:
-                targethash = hashlib.md5()
-            while True:
-                buf = targetfh.read(16 * 1024)
-                if not buf:
-                    break
-                targethash.update(buf)
-
-        if targethash.digest() != sourcehash.digest():
-            error_template = 'ubiquity/install/copying_error/md5'
-            db.subst(error_template, 'FILE', targetpath)
-            db.input('critical', error_template)
-            db.go()
-            response = db.get(error_template)
-            if response == 'skip':
-                break
-            elif response == 'abort':
-                syslog.syslog(syslog.LOG_ERR, 'MD5 failure on %s' % targetpath)
-                sys.exit(3)
-            elif response == 'retry':
-                pass
+
+COPY_JOURNAL_MAGIC = b'UBQJRNL1\n'
+
+
+class CopyJournal:
+    """A record, kept on the target, of the files that copy_all has copied.
+
+    If copying is interrupted (say, by a read error from a flaky USB stick)
+    and the installer is run again without reformatting the target, then
+    there's no need to copy files that the journal says were finished and
+    that still look the way we left them.  Each line records a file's size,
+    modification time in microseconds, digest from the live medium (or
+    '-'), and relative path.  Lines are only ever appended, so at worst an
+    interruption leaves a truncated last line, which we ignore.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        try:
+            with open(path, 'rb') as journal:
+                if journal.readline() == COPY_JOURNAL_MAGIC:
+                    for line in journal:
+                        if not line.endswith(b'\n'):
+                            break
+                        try:
+                            size, mtime, digest, relpath = (
+                                line[:-1].split(b' ', 3))
+                            self.done[os.fsdecode(relpath)] = (
+                                int(size), int(mtime), digest)
+                        except ValueError:
+                            continue
+        except FileNotFoundError:
+            pass
+        if self.done:
+            self._journal = open(path, 'ab')
         else:
-            break
+            self._journal = open(path, 'wb')
+            self._journal.write(COPY_JOURNAL_MAGIC)
+
+    @staticmethod
+    def _key(st, expected):
+        if expected is not None:
+            digest = expected.hex().encode('ascii')
+        else:
+            digest = b'-'
+        return st.st_size, round(st.st_mtime * 1000000), digest
+
+    def completed(self, relpath, targetpath, st, expected=None):
+        """Has relpath already been copied to targetpath?
+
+        st and expected describe the source file, as for copy_file_data;
+        if either they or the target have changed since the journal entry
+        was written, then the file must be copied again.
+        """
+        key = self._key(st, expected)
+        if self.done.get(relpath) != key:
+            return False
+        try:
+            st_target = os.lstat(targetpath)
+        except OSError:
+            return False
+        return (stat.S_ISREG(st_target.st_mode) and
+                self._key(st_target, expected) == key)
+
+    def record(self, relpath, st, expected=None):
+        """Record that relpath has been copied and verified."""
+        if '\n' in relpath:
+            # Can't be journalled; we'll just have to copy it again.
+            return
+        size, mtime, digest = self._key(st, expected)
+        self._journal.write(b'%d %d %s %s\n' % (
+            size, mtime, digest, os.fsencode(relpath)))
+
+    def close(self):
+        self._journal.close()
+
+    def remove(self):
+        """Remove the journal once copying has finished."""
+        self._journal.close()
+        osextras.unlink_force(self.path)
 
 
 class InstallBase:
@@ -855,61 +2272,52 @@ class InstallBase:
 
     def commit_with_verify(self, cache, fetch_progress, install_progress):
         # Hack around occasional undetected download errors in apt by doing
-        # our own verification pass at the end.  See
+        # our own verification as each download completes.  See
         # https://bugs.launchpad.net/bugs/922949.  Unfortunately this means
         # clone-and-hacking most of cache.commit ...
         pm = apt_pkg.PackageManager(cache._depcache)
         fetcher = apt_pkg.Acquire(fetch_progress)
+        hashes = archive_hashes(cache)
         while True:
-            # fetch archives first
-            res = cache._fetch_archives(fetcher, pm)
-
-            # manually verify all the downloads
-            syslog.syslog('Verifying downloads ...')
-            for item in fetcher.items:
-                with open(item.destfile, 'rb') as destfile:
-                    st = os.fstat(destfile.fileno())
-                    if st.st_size != item.filesize:
-                        osextras.unlink_force(item.destfile)
-                        raise IOError(
-                            "%s size mismatch: %ld != %ld" %
-                            (item.destfile, st.st_size, item.filesize))
-
-                    # Mapping back to the package object is an utter pain.
-                    # If we fail to find one, it's entirely possible it's a
-                    # programming error and not a download error, so skip
-                    # verification in such cases rather than failing.
-                    destfile_base = os.path.basename(item.destfile)
-                    try:
-                        name, version, arch = destfile_base.split('_')
-                        version = version.replace('%3a', ':')
-                        arch = arch.split('.')[0]
-                        if arch == 'all':
-                            fullname = name
-                        else:
-                            fullname = '%s:%s' % (name, arch)
-                            # This syntax only works on systems configured
-                            # for multiarch, so check and fall back to the
-                            # single-architecture syntax.
-                            if fullname not in cache:
-                                fullname = name
-                        candidate = cache[fullname].versions[version]
-                    except (KeyError, ValueError) as e:
-                        syslog.syslog(
-                            'Failed to find package object for %s: %s' %
-                            (item.destfile, e))
-                        continue
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=os.cpu_count() or 1) as executor:
+                verifying = {}
 
-                    if candidate.sha256 is not None:
-                        sha256 = hashlib.sha256()
-                        for chunk in iter(lambda: destfile.read(16384), b''):
-                            sha256.update(chunk)
-                        if sha256.hexdigest() != candidate.sha256:
-                            osextras.unlink_force(item.destfile)
-                            raise IOError(
-                                "%s SHA256 checksum mismatch: %s != %s" %
-                                (item.destfile, sha256.hexdigest(),
-                                 candidate.sha256))
+                def verify(destfile, filesize):
+                    if destfile in verifying:
+                        return
+                    name = os.path.splitext(os.path.basename(destfile))[0]
+                    if name not in hashes:
+                        # If this happens, it's more likely to be a
+                        # programming error than a download error, so
+                        # only check the size.
+                        syslog.syslog(
+                            'Failed to find package object for %s' %
+                            destfile)
+                    verifying[destfile] = executor.submit(
+                        verify_archive, destfile, filesize,
+                        hashes.get(name))
+
+                # Start verifying each archive as soon as apt has
+                # downloaded it, while it gets on with the rest.
+                on_done = getattr(fetch_progress, 'on_done', None)
+                fetch_progress.on_done = (
+                    lambda item: verify(item.owner.destfile,
+                                        item.owner.filesize))
+
+                # fetch archives first
+                try:
+                    res = cache._fetch_archives(fetcher, pm)
+                finally:
+                    fetch_progress.on_done = on_done
+
+                # Archives that were already present, or that weren't in
+                # place yet when apt reported them done, are verified here.
+                syslog.syslog('Verifying downloads ...')
+                for item in fetcher.items:
+                    verify(item.destfile, item.filesize)
+                for future in verifying.values():
+                    future.result()
             syslog.syslog('Downloads verified successfully')
 
             # then install
@@ -942,73 +2350,72 @@ class InstallBase:
             'ubiquity/install/apt_indices_starting',
             'ubiquity/install/apt_indices')
 
-        with Cache() as cache:
+        cache = shared_cache()
+        if cache._depcache.broken_count > 0:
+            syslog.syslog(
+                'not installing additional packages, since there are'
+                ' broken packages: %s' % ', '.join(broken_packages(cache)))
+            self.db.progress('STOP')
+            self.nested_progress_end()
+            return
 
-            if cache._depcache.broken_count > 0:
-                syslog.syslog(
-                    'not installing additional packages, since there are'
-                    ' broken packages: %s' % ', '.join(broken_packages(cache)))
-                self.db.progress('STOP')
-                self.nested_progress_end()
-                return
+        with cache.actiongroup():
+            mark_install(cache, to_install)
 
-            with cache.actiongroup():
-                mark_install(cache, to_install)
-
-            self.db.progress('SET', 1)
-            self.progress_region(1, 10)
-            if langpacks:
-                fetchprogress = DebconfAcquireProgress(
-                    self.db, 'ubiquity/langpacks/title', None,
-                    'ubiquity/langpacks/packages')
-                installprogress = DebconfInstallProgress(
-                    self.db, 'ubiquity/langpacks/title',
-                    'ubiquity/install/apt_info')
-            else:
-                fetchprogress = DebconfAcquireProgress(
-                    self.db, 'ubiquity/install/title', None,
-                    'ubiquity/install/fetch_remove')
-                installprogress = DebconfInstallProgress(
-                    self.db, 'ubiquity/install/title',
-                    'ubiquity/install/apt_info',
-                    'ubiquity/install/apt_error_install')
-            chroot_setup(self.target)
-            commit_error = None
+        self.db.progress('SET', 1)
+        self.progress_region(1, 10)
+        if langpacks:
+            fetchprogress = DebconfAcquireProgress(
+                self.db, 'ubiquity/langpacks/title', None,
+                'ubiquity/langpacks/packages')
+            installprogress = DebconfInstallProgress(
+                self.db, 'ubiquity/langpacks/title',
+                'ubiquity/install/apt_info')
+        else:
+            fetchprogress = DebconfAcquireProgress(
+                self.db, 'ubiquity/install/title', None,
+                'ubiquity/install/fetch_remove')
+            installprogress = DebconfInstallProgress(
+                self.db, 'ubiquity/install/title',
+                'ubiquity/install/apt_info',
+                'ubiquity/install/apt_error_install')
+        chroot_setup(self.target)
+        commit_error = None
+        try:
             try:
-                try:
-                    if not self.commit_with_verify(
-                            cache, fetchprogress, installprogress):
-                        fetchprogress.stop()
-                        installprogress.finish_update()
-                        self.db.progress('STOP')
-                        self.nested_progress_end()
-                        return
-                except IOError:
-                    for line in traceback.format_exc().split('\n'):
-                        syslog.syslog(syslog.LOG_ERR, line)
+                if not self.commit_with_verify(
+                        cache, fetchprogress, installprogress):
                     fetchprogress.stop()
                     installprogress.finish_update()
                     self.db.progress('STOP')
                     self.nested_progress_end()
                     return
-                except SystemError as e:
-                    for line in traceback.format_exc().split('\n'):
-                        syslog.syslog(syslog.LOG_ERR, line)
-                    commit_error = str(e)
-            finally:
-                chroot_cleanup(self.target)
-            self.db.progress('SET', 10)
+            except IOError:
+                for line in traceback.format_exc().split('\n'):
+                    syslog.syslog(syslog.LOG_ERR, line)
+                fetchprogress.stop()
+                installprogress.finish_update()
+                self.db.progress('STOP')
+                self.nested_progress_end()
+                return
+            except SystemError as e:
+                for line in traceback.format_exc().split('\n'):
+                    syslog.syslog(syslog.LOG_ERR, line)
+                commit_error = str(e)
+        finally:
+            chroot_cleanup(self.target)
+        self.db.progress('SET', 10)
 
-            cache.open(None)
-            if commit_error or cache._depcache.broken_count > 0:
-                if commit_error is None:
-                    commit_error = ''
-                brokenpkgs = broken_packages(cache)
-                self.warn_broken_packages(brokenpkgs, commit_error)
+        cache = shared_cache()
+        if commit_error or cache._depcache.broken_count > 0:
+            if commit_error is None:
+                commit_error = ''
+            brokenpkgs = broken_packages(cache)
+            self.warn_broken_packages(brokenpkgs, commit_error)
 
-            self.db.progress('STOP')
+        self.db.progress('STOP')
 
-            self.nested_progress_end()
+        self.nested_progress_end()
 
     def select_language_packs(self, save=False):
         try:
@@ -1025,11 +2432,15 @@ class InstallBase:
         try:
             langpack_db = self.db.get('pkgsel/language-packs')
             if langpack_db == 'ALL':
-                apt_subp = subprocess.Popen(
-                    ['apt-cache', '-n', 'search', '^language-pack-[^-][^-]*$'],
-                    stdout=subprocess.PIPE, universal_newlines=True)
-                apt_out = apt_subp.communicate()[0].rstrip().split('\n')
-                langpacks = [x.split('-')[2].strip() for x in apt_out]
+                # Equivalent to apt-cache -n search, without reading the
+                # cache all over again in another process.
+                re_langpack = re.compile(r'^language-pack-([^-][^-]*)$')
+                langpack_set = set()
+                for pkg in shared_cache()._cache.packages:
+                    match = re_langpack.match(pkg.name)
+                    if match is not None and pkg.has_versions:
+                        langpack_set.add(match.group(1))
+                langpacks = sorted(langpack_set)
                 all_langpacks = True
             else:
                 langpacks = langpack_db.replace(',', '').split()
@@ -1062,11 +2473,30 @@ class InstallBase:
         except debconf.DebconfError:
             return
 
-        cache = Cache()
+        cache = shared_cache()
 
         to_install = []
         checker = osextras.find_on_path('check-language-support')
-        for lp_locale in langpacks:
+
+        def check_language_support(lp_locale):
+            check_lang = subprocess.Popen(
+                ['check-language-support', '-l', lp_locale.split('.')[0],
+                 '--show-installed'],
+                stdout=subprocess.PIPE, universal_newlines=True)
+            return check_lang.communicate()[0].strip().split()
+
+        # If pkgsel/language-packs is ALL, then speed things up by calling
+        # check-language-support just once.  Otherwise, it takes a while to
+        # start up, so run it for all the locales at once.
+        if not all_langpacks and checker:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=os.cpu_count() or 1) as executor:
+                language_support = list(
+                    executor.map(check_language_support, langpacks))
+        else:
+            language_support = [None] * len(langpacks)
+
+        for lp_locale, support in zip(langpacks, language_support):
             lp = locale_to_language_pack(lp_locale)
             # Basic language packs, required to get localisation working at
             # all. We install these almost unconditionally; if you want to
@@ -1077,14 +2507,8 @@ class InstallBase:
             for pattern in lppatterns:
                 to_install.append(pattern.replace('$LL', lp))
             # More extensive language support packages.
-            # If pkgsel/language-packs is ALL, then speed things up by
-            # calling check-language-support just once.
-            if not all_langpacks and checker:
-                check_lang = subprocess.Popen(
-                    ['check-language-support', '-l', lp_locale.split('.')[0],
-                     '--show-installed'],
-                    stdout=subprocess.PIPE, universal_newlines=True)
-                to_install.extend(check_lang.communicate()[0].strip().split())
+            if support is not None:
+                to_install.extend(support)
             else:
                 to_install.append('language-support-%s' % lp)
             if checker:
@@ -9,6 +9,7 @@ import re
 import shutil
 import subprocess
 import syslog
+import time
 import json
 
 from ubiquity import osextras
@@ -594,25 +595,37 @@ def get_install_medium():
 get_install_medium.medium = ''
 
 
-def execute(*args):
-    """runs args* in shell mode. Output status is taken."""
+def run_logged(args, **kwargs):
+    """Run args, logging its output to syslog line by line.
+
+    This does the job of log-output without forking it for every command
+    we run.  The command line is logged afterwards along with how long it
+    took.  Any extra keyword arguments are passed to subprocess.Popen.
+    Returns the exit status; OSError is raised if args can't be run.
+    """
+    start = time.time()
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, **kwargs)
+    with proc.stdout:
+        for line in proc.stdout:
+            syslog.syslog(syslog.LOG_NOTICE,
+                          line.rstrip(b'\n').decode('UTF-8', 'replace'))
+    status = proc.wait()
+    syslog.syslog(syslog.LOG_ERR if status else syslog.LOG_INFO,
+                  '%s (exit %d, %.3fs)' %
+                  (' '.join(args), status, time.time() - start))
+    return status
 
-    log_args = ['log-output', '-t', 'ubiquity']
-    log_args.extend(args)
 
+def execute(*args):
+    """runs args* in shell mode. Output status is taken."""
     try:
-        status = subprocess.call(log_args)
-    except IOError as e:
-        syslog.syslog(syslog.LOG_ERR, ' '.join(log_args))
+        return run_logged(args) == 0
+    except OSError as e:
+        syslog.syslog(syslog.LOG_ERR, ' '.join(args))
         syslog.syslog(syslog.LOG_ERR,
                       "OS error(%s): %s" % (e.errno, e.strerror))
         return False
-    else:
-        if status != 0:
-            syslog.syslog(syslog.LOG_ERR, ' '.join(log_args))
-            return False
-        syslog.syslog(' '.join(log_args))
-        return True
 
 
 @raise_privileges
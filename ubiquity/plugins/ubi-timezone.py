@@ -512,9 +512,14 @@ class Page(plugin.Plugin):
     def build_timezone_list(self):
         total = []
         continents = self.choices_untranslated('localechooser/continentlist')
+        self.prefetch_templates(
+            ['localechooser/countrylist/%s' % continent.replace(' ', '_')
+             for continent in continents], fields=('choices-c',))
         for continent in continents:
             country_codes = self.choices_untranslated(
                 'localechooser/countrylist/%s' % continent.replace(' ', '_'))
+            self.prefetch_templates(
+                ['tzsetup/country/%s' % c for c in country_codes])
             for c in country_codes:
                 shortlist = self.build_shortlist_timezone_pairs(c, sort=False)
                 longlist = self.build_longlist_timezone_pairs(c, sort=False)
@@ -607,6 +612,9 @@ class Page(plugin.Plugin):
         try:
             continents = self.choices_untranslated(
                 'localechooser/continentlist')
+            self.prefetch_templates(
+                ['localechooser/countrylist/%s' % continent.replace(' ', '_')
+                 for continent in continents])
             for continent in continents:
                 choices = self.choices_display_map(
                     'localechooser/countrylist/%s' %
@@ -625,6 +633,7 @@ class Page(plugin.Plugin):
         # cache this info), but we don't need to run this often.
         try:
             areas = self.choices_untranslated('tzdata/Areas')
+            self.prefetch_templates(['tzdata/Zones/%s' % area for area in areas])
             for area in areas:
                 zones = self.choices_display_map('tzdata/Zones/%s' % area)
                 for name, code in zones.items():
@@ -20,10 +20,13 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 
+import array
 import json
 import os
 import stat
 import syslog
+import threading
+import time
 
 from ubiquity.misc import raise_privileges
 
@@ -123,4 +126,118 @@ class _Telemetry():
             syslog.syslog(syslog.LOG_ERR,
                           "Exception while storing telemetry data: " + str(e))
 
+
+class CopyTimer():
+    """Time the phases of copying a single file.
+
+    Call lap() at the end of each phase with its name; the time since the
+    previous lap (or since the timer was created) is charged to it.
+    """
+
+    __slots__ = ('phases', 'start', 'last')
+
+    def __init__(self):
+        self.phases = {}
+        self.start = self.last = time.monotonic()
+
+    def lap(self, phase):
+        now = time.monotonic()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def elapsed(self):
+        return self.last - self.start
+
+
+class CopyStats():
+    """Collect throughput and timing statistics for the file copy phase.
+
+    Timers may be added from several threads at once.  Phase times are
+    summed over all threads, so they may add up to more than the elapsed
+    time when copying in parallel.
+    """
+
+    PHASES = ('read', 'write', 'copy', 'fsync', 'metadata', 'verify')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._end = None
+        self._files = 0
+        self._other = 0
+        self._bytes = 0
+        self._phases = dict.fromkeys(self.PHASES, 0.0)
+        self._latencies = array.array('d')
+
+    def add(self, timer, size=0, regular=True):
+        """Record a timer for one copied item of the given size.
+
+        Only regular files count towards files per second and per-file
+        latency; other items (directories, symlinks, and so on) only
+        contribute their phase times.
+        """
+        with self._lock:
+            for phase, seconds in timer.phases.items():
+                self._phases[phase] = self._phases.get(phase, 0.0) + seconds
+            if regular:
+                self._files += 1
+                self._bytes += size
+                self._latencies.append(timer.elapsed())
+            else:
+                self._other += 1
+
+    def finish(self):
+        """Stop the clock."""
+        self._end = time.monotonic()
+
+    def _percentile(self, ordered, percent):
+        if not ordered:
+            return 0.0
+        rank = max(int(round(percent / 100.0 * len(ordered))) - 1, 0)
+        return ordered[rank]
+
+    def summary(self):
+        """Return a dictionary summarising the statistics so far."""
+        with self._lock:
+            end = self._end if self._end is not None else time.monotonic()
+            elapsed = max(end - self._start, 1e-6)
+            ordered = sorted(self._latencies)
+            return {
+                'Elapsed': elapsed,
+                'Files': self._files,
+                'OtherItems': self._other,
+                'Bytes': self._bytes,
+                'BytesPerSecond': self._bytes / elapsed,
+                'FilesPerSecond': self._files / elapsed,
+                'PhaseSeconds': dict(self._phases),
+                'FileLatency': {
+                    'p50': self._percentile(ordered, 50),
+                    'p90': self._percentile(ordered, 90),
+                    'p99': self._percentile(ordered, 99),
+                    'max': ordered[-1] if ordered else 0.0,
+                },
+            }
+
+    def save(self, path):
+        """Save the summary as JSON to path, and log it to syslog."""
+        summary = self.summary()
+        syslog.syslog(
+            'Copied %d files (%d bytes) in %.1fs: %.1f MB/s, %.1f files/s' %
+            (summary['Files'], summary['Bytes'], summary['Elapsed'],
+             summary['BytesPerSecond'] / 1000000,
+             summary['FilesPerSecond']))
+        try:
+            target_dir = os.path.dirname(path)
+            if not os.path.exists(target_dir):
+                os.makedirs(target_dir)
+            with open(path, 'w') as f:
+                json.dump(summary, f)
+            os.chmod(path,
+                     stat.S_IRUSR | stat.S_IWUSR |
+                     stat.S_IRGRP | stat.S_IROTH)
+        except OSError as e:
+            syslog.syslog(syslog.LOG_ERR,
+                          "Exception while storing copy statistics: " +
+                          str(e))
+
 # vim:ai:et:sts=4:tw=80:sw=4: